@@ -0,0 +1,225 @@
+# Module: batch
+# - Owns the lifecycle of the decoded DSS frames of a batch run: each
+#   frame is fetched, decoded and closed exactly once, with its HDUList
+#   closed as soon as the guider region has been read
+# - Prefetches the next frames in background threads, fetching up to
+#   prefetch of them at once so that image server latency overlaps,
+#   under a memory ceiling that holds the prefetch back while too much
+#   is decoded
+# - Reports memory high-water marks
+# Usage:
+#       >>> import batch
+#       >>> engine = batch.FrameEngine(load, limit=256*2**20)
+#       >>> for frame in engine.frames(keys):
+#       ...     with frame:
+#       ...         render(frame.plate, frame.data, frame.grey, frame.origin)
+#       ...     print(engine.memoryReport())
+# External modules needed:
+#       numpy, astropy (through dss and fits2pil)
+#
+# The ceiling applies to frames held by the engine and its consumer; it
+# may be exceeded by one frame, so a frame larger than the ceiling is
+# still rendered, plus the up to prefetch frames still being loaded.
+
+import collections
+import os
+import queue
+import sys
+import threading
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+class Frame:
+    """A decoded DSS frame: the plate solution, the central section of
+    the image and its 8-bit display version.  Closing a frame drops its
+    arrays and returns its memory to the engine."""
+    def __init__(self, key, fitsfile, plate, data, grey, origin):
+        self.key = key
+        self.fitsfile = fitsfile
+        self.plate = plate
+        self.data = data
+        self.grey = grey
+        self.origin = origin
+        self.nbytes = data.nbytes + grey.nbytes
+        self.engine = None
+
+    def close(self):
+        if self.data is None:
+            return
+        self.data = None
+        self.grey = None
+        if self.engine is not None:
+            self.engine._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def loadFrame(key, fitsfile, halfsize, compress=True, source=None):
+    """Fetches the DSS image of key = (ra, dec) into fitsfile unless it
+    is already there, from source (an imagesource, MAST by default), and
+    returns its Frame.  The FITS file is closed before returning and the
+    plate solution is read from its sidecar."""
+    import dss
+    import fits2pil
+    d = dss.DSS(source)
+    d.compress = compress
+    with d.getDSSImage(key[0], key[1], fitsfile) as hdulist:
+        data, origin = dss.centralSection(hdulist, halfsize)
+    d.getWCS(fitsfile)
+    return Frame(key, fitsfile, d, data, fits2pil.arrayToGreyArray(data), origin)
+
+_peak = None
+
+def rss():
+    """Returns (current, peak) resident set size of this process in
+    bytes; either is None where the platform does not report it"""
+    current = None
+    try:
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    peak = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        if sys.platform != 'darwin':
+            peak *= 1024
+    # ru_maxrss and statm count slightly differently; keep the reported
+    # peak monotonic and never below the current size
+    global _peak
+    if peak is not None:
+        _peak = peak = max(_peak or 0, peak, current or 0)
+    return current, peak
+
+def openFiles():
+    """Returns the number of open file descriptors, or None"""
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+class FrameEngine:
+    """Loads frames ahead of the consumer, in order, while the memory
+    held by loaded frames stays under limit bytes.
+
+    load(key) returns a Frame; up to prefetch keys are loaded at once, in
+    threads, and at most prefetch loaded frames wait in the queue.  When
+    held frames reach the limit, loading pauses until the consumer
+    closes one."""
+    def __init__(self, load, limit=256*2**20, prefetch=2):
+        self.load = load
+        self.limit = limit
+        self.prefetch = prefetch
+        self.cond = threading.Condition()
+        self.held = 0
+        self.highwater = 0
+        self.loaded = 0
+        self.stopped = False
+
+    def _reserve(self):
+        # backpressure: wait for the consumer to close frames while the
+        # ceiling is reached, but always let one frame through
+        with self.cond:
+            while self.held >= self.limit and self.held > 0 and not self.stopped:
+                self.cond.wait()
+            return not self.stopped
+
+    def _account(self, frame):
+        with self.cond:
+            frame.engine = self
+            self.held += frame.nbytes
+            self.highwater = max(self.highwater, self.held)
+            self.loaded += 1
+
+    def _release(self, frame):
+        with self.cond:
+            self.held -= frame.nbytes
+            self.cond.notify_all()
+
+    def _producer(self, keys, q):
+        from concurrent.futures import ThreadPoolExecutor
+        pool = ThreadPoolExecutor(max_workers=max(self.prefetch, 1))
+        inflight = collections.deque()
+        keys = iter(keys)
+        end = object()
+        try:
+            while True:
+                # keep up to prefetch loads running, in key order
+                while len(inflight) < max(self.prefetch, 1):
+                    key = next(keys, end)
+                    if key is end:
+                        break
+                    inflight.append((key, pool.submit(self.load, key)))
+                if not inflight or not self._reserve():
+                    return
+                key, fut = inflight.popleft()
+                try:
+                    frame = fut.result()
+                except Exception as err:
+                    q.put((key, None, err))
+                    return
+                self._account(frame)
+                q.put((key, frame, None))
+        finally:
+            # loads started but no longer wanted are dropped
+            for key, fut in inflight:
+                fut.cancel()
+            pool.shutdown(wait=True)
+            q.put(None)
+
+    def frames(self, keys):
+        """Yields the Frame of every key, in order.  Each frame must be
+        closed by the consumer; a load error is raised in the consumer
+        at that frame's turn."""
+        q = queue.Queue(maxsize=max(self.prefetch, 1))
+        self.stopped = False
+        t = threading.Thread(target=self._producer, args=(list(keys), q), daemon=True)
+        t.start()
+        try:
+            while True:
+                item = q.get()
+                if item is None:
+                    break
+                key, frame, err = item
+                if err is not None:
+                    raise err
+                yield frame
+        finally:
+            with self.cond:
+                self.stopped = True
+                self.cond.notify_all()
+            # drain and close whatever was prefetched but not consumed
+            while t.is_alive() or not q.empty():
+                try:
+                    item = q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is not None and item[1] is not None:
+                    item[1].close()
+            t.join()
+
+    def memoryReport(self):
+        """Returns a one-line summary of frame memory and process memory
+        high-water marks"""
+        with self.cond:
+            held = self.held
+            highwater = self.highwater
+        current, peak = rss()
+        mb = 1.0/2**20
+        line = "frames %.1f MB (high-water %.1f MB, limit %.0f MB)" % (
+            held*mb, highwater*mb, self.limit*mb)
+        if current is not None:
+            line += ", rss %.1f MB" % (current*mb)
+        if peak is not None:
+            line += " (high-water %.1f MB)" % (peak*mb)
+        nfd = openFiles()
+        if nfd is not None:
+            line += ", %d open files" % nfd
+        return line
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""Compares uncompressed and Rice tile-compressed storage of cached DSS
+images: disk footprint, read latency and guider render time.
+
+Usage:
+        python bench_dsscache.py [-n runs] file1_dss.fits .. fileN_dss.fits
+
+Switches:
+        -n = number of timed repetitions per file (default 10)
+
+Each input image is written to a scratch directory both ways.  Reads
+are timed for the full frame and for the central guider section, which
+only decodes the tiles it overlaps; the render time covers the section
+read, the greyscale conversion and the guider view.
+"""
+
+import getopt
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import astropy.io.fits as fits
+import dss
+import fits2pil
+import deimos_guider_dss as guider
+
+def timeit(func, runs):
+    times = []
+    for i in range(runs):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times)*1000.0
+
+def readFull(path):
+    with fits.open(path) as hdulist:
+        dss.imageHDU(hdulist).data.sum()
+
+def readSection(path):
+    with fits.open(path) as hdulist:
+        dss.centralSection(hdulist, guider.view_radius)
+
+def render(path, font):
+    with fits.open(path) as hdulist:
+        data, origin = dss.centralSection(hdulist, guider.view_radius)
+    grey = fits2pil.arrayToGreyImage(data)
+    guider.guiderView(grey, 0.0, [], [], 0.0, font, origin=origin)
+
+if __name__ == '__main__':
+    optlist, args = getopt.getopt(sys.argv[1:], 'n:')
+    runs = 10
+    for o,a in optlist:
+        if o == "-n":
+            runs = int(a)
+    if not args:
+        print(__doc__)
+        sys.exit(1)
+
+    font = guider.loadFont()
+    scratch = tempfile.mkdtemp()
+    print("%-28s %-6s %9s %10s %10s %10s" % ("file", "store", "size kB",
+          "full ms", "section ms", "render ms"))
+    for f in args:
+        with fits.open(f) as hdulist:
+            plain = os.path.join(scratch, "plain.fits")
+            rice = os.path.join(scratch, "rice.fits")
+            for p in (plain, rice):
+                if os.path.exists(p):
+                    os.remove(p)
+            dss.writeImage(hdulist, plain, compress=False)
+            dss.writeImage(hdulist, rice, compress=True)
+        for label, p in (("plain", plain), ("rice", rice)):
+            print("%-28s %-6s %9.1f %10.2f %10.2f %10.2f" % (
+                os.path.basename(f)[:28], label, os.path.getsize(p)/1024.0,
+                timeit(lambda: readFull(p), runs),
+                timeit(lambda: readSection(p), runs),
+                timeit(lambda: render(p, font), runs)))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+"""Measures the start-up cost of the DEIMOS guider modules and CLIs.
+
+Usage:
+        python bench_import.py [-n runs]
+
+Switches:
+        -n = number of runs per case (default 20); the median wall time
+             of a fresh interpreter is reported, with a bare interpreter
+             as the baseline
+
+Each case runs in a new process so nothing is shared between runs.
+"""
+
+import getopt
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+cases = [
+    ("python (baseline)", ["-c", "pass"]),
+    ("import angles", ["-c", "import angles"]),
+    ("import starlist", ["-c", "import starlist"]),
+    ("import dss", ["-c", "import dss"]),
+    ("import deimos_guider_dss (Mask)", ["-c", "import deimos_guider_dss"]),
+    ("deimos_guider_dss.py -h", [os.path.join(here, "deimos_guider_dss.py"), "-h"]),
+    ("deimos_starlist.py -h", [os.path.join(here, "deimos_starlist.py"), "-h"]),
+]
+
+def timeit(args, runs):
+    times = []
+    for i in range(runs):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=here,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times)
+
+if __name__ == '__main__':
+    optlist, args = getopt.getopt(sys.argv[1:], 'n:')
+    runs = 20
+    for o,a in optlist:
+        if o == "-n":
+            runs = int(a)
+
+    base = None
+    for name, args in cases:
+        t = timeit(args, runs)
+        if base is None:
+            base = t
+        print("%-34s %7.1f ms  (+%.1f ms)" % (name, t*1000.0, (t - base)*1000.0))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""Measures the throughput of deimos_guider_dss on recorded DSS images,
+without network access.
+
+Usage:
+        python bench_pipeline.py -r recdir [-l latency] [-f fail]
+                                 [-j jobs,..] [-n runs] file1 .. fileN
+
+Switches:
+        -r = directory of recorded DSS images (see imagesource; record
+             one with deimos_guider_dss -I record:recdir)
+        -l = simulated latency per image request in seconds (default 0.5)
+        -f = fraction of image requests that fail (default 0)
+        -j = comma separated worker counts to compare (default 1,4)
+        -n = number of runs per case (default 3); the median is reported
+
+Each run renders the masks in a fresh scratch directory, so every image
+is requested from the replay source again.  deimos_guider_dss fetches
+max(2, jobs) images at a time, so the -j comparison measures the
+overlap of the simulated latency as well as parallel rendering; masks
+on one guider field share one image, so only distinct fields pay the
+latency.
+"""
+
+import getopt
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def run(masks, source, jobs):
+    scratch = tempfile.mkdtemp(prefix='bench_pipeline')
+    try:
+        names = []
+        for m in masks:
+            shutil.copy(m, scratch)
+            names.append(os.path.basename(m))
+        t0 = time.perf_counter()
+        r = subprocess.run([sys.executable, os.path.join(here, "deimos_guider_dss.py"),
+                            "-j", str(jobs), "-I", source] + names, cwd=scratch,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        t = time.perf_counter() - t0
+        # an image that cannot be had stops the run before the index
+        ok = r.returncode == 0 and os.path.exists(os.path.join(scratch, 'guider_images.html'))
+    finally:
+        shutil.rmtree(scratch)
+    return t, ok
+
+if __name__ == '__main__':
+    optlist, masks = getopt.getopt(sys.argv[1:], 'r:l:f:j:n:')
+    recdir = None
+    latency = 0.5
+    fail = 0.0
+    jobs = [1, 4]
+    runs = 3
+    for o,a in optlist:
+        if o == "-r":
+            recdir = os.path.abspath(a)
+        elif o == "-l":
+            latency = float(a)
+        elif o == "-f":
+            fail = float(a)
+        elif o == "-j":
+            jobs = [int(j) for j in a.split(',')]
+        elif o == "-n":
+            runs = int(a)
+    if recdir is None or not masks:
+        print(__doc__)
+        sys.exit(2)
+    masks = [os.path.abspath(m) for m in masks]
+
+    source = 'replay:%s:latency=%g:fail=%g' % (recdir, latency, fail)
+    print("%d masks, %s" % (len(masks), source))
+    for j in jobs:
+        results = [run(masks, source, j) for i in range(runs)]
+        t = statistics.median(r[0] for r in results)
+        failed = sum(1 for r in results if not r[1])
+        print("-j %-3d %8.2f s  %6.2f masks/s%s" % (j, t, len(masks)/t,
+              "  (%d failed runs)" % failed if failed else ""))
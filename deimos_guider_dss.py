@@ -5,10 +5,41 @@ pages showing predicted DEIMOS guider image views based on DSS images.
 
 Usage:
         Change to directory with your mask designs
-        deimos_guider_dss [-D] [file1 .. fileN]
+        deimos_guider_dss [-h] [-D] [-n] [-S start,stop,step] [-T] [-Z]
+                          [-j jobs] [-m megabytes] [-e exportdir [-F format]]
+                          [-I source] [file1 .. fileN]
 
 Switches:
         -D = debug mode; print each input line as it is processed
+        -n = do not search the DSS frame for guide star candidates
+        -S = also render the guider view for every PA from start to stop
+             (degrees) in steps of step, as an animated GIF and a
+             contact sheet (name_pasweep.gif, name_pasweep.png)
+        -T = also simulate the guider camera frame (guider_scale
+             arcsec/pix, TV coordinates, seeing and noise) with the guide
+             stars marked at their xTV/yTV (name_guider_tv.png)
+        -Z = also cut each DSS frame into a tile pyramid (name_dss_tiles)
+             and write a zoomable viewer page with the mask overlays
+             (name_zoom.html); up-to-date pyramids are reused
+        -j = render with jobs worker processes (default 1); each DSS
+             frame is decoded once and shared with the workers, and at
+             most shared_frames frames are shared at a time whatever
+             the number of workers
+        -m = memory ceiling for decoded DSS frames in MB (default 256);
+             the next frames are fetched and decoded ahead of rendering,
+             max(2, jobs) at a time, until it is reached
+        -e = also export every mask's header, plate solution summary,
+             guide stars and projected object positions as tables
+             (masks, guidestars, objects) in directory exportdir
+        -F = export format: parquet (needs pyarrow), csv or npz; the
+             default is parquet when pyarrow is installed, else csv
+        -I = where to get DSS images that are not on disk yet, tried in
+             turn (see imagesource.fromSpec); default mast.  E.g.
+                mast,dir:/data/dss           MAST, else a local archive
+                record:dss_rec               MAST, keeping a copy
+                replay:dss_rec:latency=0.5:fail=0.1
+                                             recorded images only, with
+                                             simulated latency/failures
 
 Args:
         fileN = DSIMULATOR output file list
@@ -42,12 +73,37 @@ Modification History:
         2013-Dec-20     GDW     - Added debug mode switch
 
         2019-Nov-25     LR      - Convert to Python 3, eliminate dependencies from custom code
+        2026-Oct-19             - Rank guide star candidates found in the
+                                DSS frame inside the guider box
+                                - Load astropy, numpy and PIL only on the
+                                rendering path; Mask is importable as a
+                                library
+                                - Add PA sweep mode (-S)
+                                - Render in worker processes (-j) from
+                                frames decoded once into shared memory;
+                                masks on one guider field share a frame
+                                - Fetch and decode frames ahead of
+                                rendering within a memory ceiling (-m);
+                                close every frame after use
+                                - Export results as tables (-e, -F)
+                                - Simulate the guider camera frame (-T)
+                                - Zoomable tiled view of the DSS frame (-Z)
+                                - Pluggable DSS image sources (-I)
                                 """
 
-import PIL.Image as Image, PIL.ImageDraw as ImageDraw
-import PIL.ImageFont as ImageFont
-import fits2pil
-from pathlib import Path
+import functools
+import html
+import math
+import os
+import re
+import sys
+import angles
+import starlist
+
+guider_scale = 0.207           # guider camera scale arcsec/pix
+guider_ccd = [212, 212]        # guider camera size in arcsec
+offset_x = 13                  # offset in X
+offset_y = -2                  # offset in Y
 
 class selectedObject:
     def __init__(self, objectlist):
@@ -77,6 +133,7 @@ class Mask:
         self.alignmentStars = []
         self.guideStars = []
         self.debug = False
+        self.file = None
 
     def readMaskFile(self, maskfile):
 
@@ -86,22 +143,21 @@ class Mask:
         f = open(self.file,"r")
         l = f.readlines()
         f.close()
+        self.parseLines(l)
+
+    def parseLines(self, l):
+        """Parses the lines (with newlines) of a DSIMULATOR output file"""
 
         # parse the second line of the file, which contains the field
         # name, field center, and equinox...
         if self.debug:
             print(l[1])
-        pattern = "^(.+)\s+(\d+:\d+:\d+\.\d+)\s+(\S*\d+:\d+:\d+\.\d+)\s+(\S+)\s+PA=\s*(\S*)\s+##"
-        mobj = re.match( pattern, l[1])
-        if mobj:
-            self.name = mobj.group(1)
-            self.ra = mobj.group(2)
-            self.dec = mobj.group(3)
-            self.equinox = float(mobj.group(4))
-            self.pa = float(mobj.group(5))
-        else:
-            print('  ERROR: line 2 does not match expected format -- abort!')
-            sys.exit(1)
+        h = starlist.parseHeader(l[1], self.file)
+        self.name = h.name
+        self.ra = h.ra
+        self.dec = h.dec
+        self.equinox = h.equinox
+        self.pa = h.pa
 
         if self.debug:
             print(l[3])
@@ -168,6 +224,101 @@ class Mask:
         for gs in rejects:
             self.guideStars.remove(gs)
 
+        self.buildIndex()
+
+    def objects(self):
+        """Returns targets, alignment stars and guide stars in one list"""
+        return self.selectedObjects + self.alignmentStars + self.guideStars
+
+    def buildIndex(self):
+        """Builds the spatial index over all objects of the mask"""
+        self.indexedObjects = self.objects()
+        self.index = skyIndex(self.indexedObjects)
+
+    def cone(self, ra, dec, radius):
+        """Returns the objects within radius (arcsec) of ra, dec (sexagesimal)"""
+        ra = angles.hrs2deg(angles.sex2deg(ra))
+        dec = angles.sex2deg(dec)
+        return [self.indexedObjects[i] for i in self.index.cone(ra, dec, radius)]
+
+    def box(self, ra, dec, width, height, pa=0.0):
+        """Returns the objects inside a width x height (arcsec) box centered
+        on ra, dec (sexagesimal) and rotated by pa (degrees)"""
+        ra = angles.hrs2deg(angles.sex2deg(ra))
+        dec = angles.sex2deg(dec)
+        return [self.indexedObjects[i]
+                for i in self.index.box(ra, dec, width, height, pa)]
+
+    def guiderField(self):
+        """Returns the objects that fall in the guider field, the box drawn
+        on the guider view"""
+        # the view rotates the DSS image by guiderRotation, so the box
+        # lies at the opposite angle on the (north up, east left) sky
+        return self.box(self.guider_ra, self.guider_dec,
+                        guider_ccd[0], guider_ccd[1], -guiderRotation(self))
+
+    def crossMatch(self, other, radius=1.0):
+        """Returns (object, other object, separation) for every object of
+        this mask within radius (arcsec) of an object of mask other"""
+        return [(self.indexedObjects[i], other.indexedObjects[j], sep)
+                for i, j, sep in self.index.crossMatch(other.index, radius)]
+
+class MaskSet:
+    def __init__(self, masks=None):
+        self.masks = []
+        for m in masks or []:
+            self.masks.append(m)
+        self.buildIndex()
+
+    def readMaskFiles(self, maskfiles, debug=False):
+        for maskfile in maskfiles:
+            m = Mask()
+            m.debug = debug
+            m.readMaskFile(maskfile)
+            self.masks.append(m)
+        self.buildIndex()
+
+    def buildIndex(self):
+        """Builds one spatial index over the objects of every mask"""
+        self.indexedObjects = []
+        self.owners = []
+        for m in self.masks:
+            for o in m.objects():
+                self.indexedObjects.append(o)
+                self.owners.append(m)
+        self.index = skyIndex(self.indexedObjects)
+
+    def cone(self, ra, dec, radius):
+        """Returns (mask, object) for the objects within radius (arcsec)
+        of ra, dec (sexagesimal)"""
+        ra = angles.hrs2deg(angles.sex2deg(ra))
+        dec = angles.sex2deg(dec)
+        return [(self.owners[i], self.indexedObjects[i])
+                for i in self.index.cone(ra, dec, radius)]
+
+    def crossMatch(self, radius=1.0):
+        """Returns (mask, object, other mask, other object, separation) for
+        every pair of objects closer than radius (arcsec) that belong to
+        different masks; each pair is reported once"""
+        pairs = []
+        for i, j, sep in self.index.crossMatch(self.index, radius):
+            if i < j and self.owners[i] is not self.owners[j]:
+                pairs.append((self.owners[i], self.indexedObjects[i],
+                              self.owners[j], self.indexedObjects[j], sep))
+        return pairs
+
+    def sharedGuideStars(self, radius=1.0):
+        """Returns the cross-mask pairs in which both objects are guide stars"""
+        return [p for p in self.crossMatch(radius)
+                if p[1] in p[0].guideStars and p[3] in p[2].guideStars]
+
+def skyIndex(objects):
+    """Builds a spatial.SkyIndex over objects with sexagesimal ra, dec"""
+    ra = [angles.hrs2deg(angles.sex2deg(o.ra)) for o in objects]
+    dec = [angles.sex2deg(o.dec) for o in objects]
+    import spatial
+    return spatial.SkyIndex(ra, dec)
+
 def drawbox(pil_draw_obj, x, y, w, l):
     x1 = x - w/2
     y1 = y - w/2
@@ -223,6 +374,323 @@ colors = {'red':        (255,   0,   0),
           'cbu_red':    (146,  21,  47),
           'navy_blue':  (  0,   0, 128)}
 
+fontpath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Fonts")
+
+@functools.lru_cache(maxsize=8)
+def loadFont(name="helvR08.pil"):
+    import PIL.ImageFont as ImageFont
+    return ImageFont.load(os.path.join(fontpath, name))
+
+def outputName(m):
+    """Returns the mask name with spaces removed, used for output files"""
+    return re.sub( r'\s', '_', m.name.strip())
+
+def paRotation(pa):
+    """Returns the rotation (degrees) applied to the DSS image for mask PA pa"""
+    return 91.4 - pa
+
+def guiderRotation(m):
+    """Returns the rotation (degrees) applied to the DSS image for mask m"""
+    return paRotation(m.pa)
+
+def guideCandidates(m, dss, data, origin=(0, 0)):
+    """Searches the DSS frame (or the section of it starting at pixel
+    origin) for guide star candidates in the guider box; returns all
+    sources found and the ranked candidates"""
+    import findstars
+    gxy = (origin[0] + data.shape[1]/2, origin[1] + data.shape[0]/2)
+    sources = findstars.findSources(data, origin=origin)
+    candidates = findstars.rankCandidates(sources, dss, gxy, guiderRotation(m),
+                                          box=guider_ccd[0])
+    print("  %d sources found, %d guide star candidates" % (len(sources), len(candidates)))
+    return sources, candidates
+
+def guideStarPositions(m, dss):
+    """Returns (label, x, y) DSS pixel positions of the guide stars of m,
+    projected in one batch"""
+    ra = [angles.hrs2deg(angles.sex2deg(gs.ra)) for gs in m.guideStars]
+    dec = [angles.sex2deg(gs.dec) for gs in m.guideStars]
+    x, y = dss.rd2xyArray(ra, dec)
+    return [(gs.id.upper(), float(x[i]), float(y[i]))
+            for i, gs in enumerate(m.guideStars)]
+
+# half size of the central part of the DSS frame that the rotated 320x320
+# view can reach: 160*sqrt(2) plus room for the bicubic kernel
+view_radius = 230
+
+# DSS frames held in shared memory at once with -j: the workers render
+# the masks of these fields while the next frame is decoded.  Fixed, so
+# memory does not grow with the number of workers; masks on one field
+# still render in parallel.
+shared_frames = 3
+
+def guiderView(grey, pa, stars, candidates, skypa, font, size=320, origin=(0, 0)):
+    """Renders the size x size guider view of the greyscale DSS image
+    grey for mask PA pa: the image rotated about its center, the guider
+    box, guide stars ((label, x, y) list), candidates and compass.
+    grey may be a centered section of the frame starting at pixel origin.
+
+    This is grey.rotate() followed by a central crop, done as one affine
+    transform so that only the output pixels are interpolated."""
+    import PIL.Image as Image, PIL.ImageDraw as ImageDraw
+    rotate = paRotation(pa)
+    # the matrix Image.rotate() uses, shifted to the origin of the crop
+    w, h = grey.size
+    cx = w/2.0
+    cy = h/2.0
+    ox = int(round(cx - size/2))
+    oy = int(round(cy - size/2))
+    angle = -math.radians(rotate % 360.0)
+    a = round(math.cos(angle), 15)
+    b = round(math.sin(angle), 15)
+    c = a*(-cx) + b*(-cy) + cx + a*ox + b*oy
+    f = -b*(-cx) + a*(-cy) + cy - b*ox + a*oy
+    im = grey.transform((size, size), Image.AFFINE, (a, b, c, -b, a, f),
+                        Image.BICUBIC).convert('RGB')
+    # guider center in view coordinates and in frame pixels
+    gxy = (cx - ox, cy - oy)
+    fxy = (origin[0] + cx, origin[1] + cy)
+    draw = ImageDraw.Draw(im)
+    #draw.setfont(font)
+    #draw.setink(colors['black'])
+    draw.line((gxy[0]-106, gxy[1]+23, gxy[0]+106, gxy[1]+23), fill=colors['black'])
+    drawbox(draw, gxy[0], gxy[1], 212, 212)
+    radrot = rotate*(math.pi/180.0)
+    for label, gsx, gsy in stars:
+        gsrxy = rotxy(gsx - fxy[0], gsy - fxy[1], radrot)
+        gsrxy[0] = gsrxy[0] + gxy[0]
+        gsrxy[1] = gxy[1] - gsrxy[1]
+        #draw.setink(colors['red'])
+        draw.text((gsrxy[0]+10, gsrxy[1]-10), label, font = font, fill=colors['red'])
+        drawcircle(draw, gsrxy[0], gsrxy[1], 10)
+    for cand in candidates:
+        crxy = rotxy(cand.x - fxy[0], cand.y - fxy[1], radrot)
+        crxy[0] = crxy[0] + gxy[0]
+        crxy[1] = gxy[1] - crxy[1]
+        draw.text((crxy[0]+8, crxy[1]+2), 'C%d' % cand.rank, font = font, fill=colors['cyan'])
+        drawbox(draw, crxy[0], crxy[1], 14, 14)
+    #draw.setink(colors['blue'])
+    drawcompass(draw, gxy[0]-116, gxy[1]-116, pa-skypa, fill=colors['blue'])
+    #font=ImageFont.load(fontpath+"/helvR12.pil")
+    #draw.setfont(font)
+    return im
+
+def guiderImage(m, dss, grey, candidates=(), font=None, origin=(0, 0)):
+    """Draws the guider box, guide stars, candidates and compass for mask
+    m on the greyscale DSS image grey (a section starting at pixel origin
+    when given) and returns the 320x320 view"""
+    if font is None:
+        font = loadFont()
+    return guiderView(grey, m.pa, guideStarPositions(m, dss), candidates,
+                      dss.skyPA(), font, origin=origin)
+
+def paSweep(m, dss, grey, pas, sources=None, font=None, origin=(0, 0)):
+    """Returns the guider views of mask m for every PA in pas.
+
+    The guide stars are projected and the sky PA computed once; each
+    PA then only costs one affine resampling of the view.  Candidates
+    are re-ranked per PA when the frame's sources are given."""
+    if font is None:
+        font = loadFont()
+    center = (origin[0] + grey.size[0]/2, origin[1] + grey.size[1]/2)
+    stars = guideStarPositions(m, dss)
+    skypa = dss.skyPA()
+    views = []
+    for pa in pas:
+        candidates = []
+        if sources is not None:
+            import findstars
+            candidates = findstars.rankCandidates(sources, dss, center, paRotation(pa),
+                                                  box=guider_ccd[0])
+        views.append(guiderView(grey, pa, stars, candidates, skypa, font,
+                                origin=origin))
+    return views
+
+def contactSheet(views, pas, columns=6, size=160, font=None):
+    """Tiles the guider views, scaled to size pixels and labelled with
+    their PA, into one image"""
+    import PIL.Image as Image, PIL.ImageDraw as ImageDraw
+    if font is None:
+        font = loadFont()
+    rows = -(-len(views)//columns)
+    sheet = Image.new('RGB', (columns*size, rows*size), colors['white'])
+    draw = ImageDraw.Draw(sheet)
+    for i, (view, pa) in enumerate(zip(views, pas)):
+        x = (i % columns)*size
+        y = (i//columns)*size
+        sheet.paste(view.resize((size, size), Image.BILINEAR), (x, y))
+        draw.text((x+4, y+size-14), 'PA=%.1f' % pa, font = font, fill=colors['yellow'])
+    return sheet
+
+def sweepPalette():
+    """Returns a palette image with the overlay colors and 248 greys,
+    shared by all frames of a PA sweep animation"""
+    import PIL.Image as Image
+    pal = []
+    for name in ('red', 'cyan', 'blue', 'black', 'yellow', 'white', 'green', 'pink'):
+        pal.extend(colors[name])
+    for i in range(248):
+        g = int(round(i*255/247.0))
+        pal.extend((g, g, g))
+    im = Image.new('P', (1, 1))
+    im.putpalette(pal)
+    return im
+
+def saveSweep(views, filename, duration=250):
+    """Saves the PA sweep views as an animated GIF"""
+    import PIL.Image as Image
+    pal = sweepPalette()
+    frames = [v.quantize(palette=pal, dither=Image.Dither.NONE) for v in views]
+    frames[0].save(filename, save_all=True, append_images=frames[1:],
+                   duration=duration, loop=0)
+
+def paRange(spec):
+    """Parses start,stop,step (degrees) into the list of PAs to sweep"""
+    start, stop, step = [float(v) for v in spec.split(',')]
+    if step <= 0:
+        raise ValueError('PA step must be positive')
+    if stop < start:
+        raise ValueError('PA stop %g is below start %g' % (stop, start))
+    n = int((stop - start)/step + 1e-9) + 1
+    return [start + i*step for i in range(n)]
+
+def renderMask(m, dss, data, origin, grey, find_candidates=True, sweep=None,
+               font=None, simulate=False):
+    """Writes the guider image, the optional PA sweep and simulated
+    guider frame, and the HTML page of mask m from its decoded DSS frame"""
+    if font is None:
+        font = loadFont()
+    output = outputName(m)
+    guider_gifout = output+'_guider_dss.gif'
+    htmlout = output+'_dss.html'
+    sources = None
+    candidates = []
+    if find_candidates:
+        sources, candidates = guideCandidates(m, dss, data, origin)
+    im = guiderImage(m, dss, grey, candidates, font, origin)
+    im.save(guider_gifout)
+
+    if sweep:
+        views = paSweep(m, dss, grey, sweep, sources, font, origin)
+        sweep_gifout = output+'_pasweep.gif'
+        sweep_sheet = output+'_pasweep.png'
+        saveSweep(views, sweep_gifout)
+        contactSheet(views, sweep).save(sweep_sheet, compress_level=1)
+        print("  PA sweep of %d views -> %s, %s" % (len(views), sweep_gifout, sweep_sheet))
+
+    if simulate:
+        import guidersim
+        frame, geom = guidersim.simulateGuider(m, dss, data, origin)
+        tv_pngout = output+'_guider_tv.png'
+        guidersim.tvImage(frame, m, geom, dss, font).save(tv_pngout, compress_level=1)
+        print("  simulated guider frame -> %s" % tv_pngout)
+
+    # build html for guider image
+    maskdoc = open(htmlout, 'w')
+    maskdoc.write(maskPage(m, guider_gifout, candidates))
+    maskdoc.close()
+
+def renderWorker(m, fitsfile, desc, origin, find_candidates=True, sweep=None,
+                 simulate=False):
+    """Renders mask m in a worker process from a frame published in
+    shared memory (see sharedframes); the plate solution comes from the
+    sidecar of fitsfile.  Returns the (current, peak) resident set size
+    of the worker in bytes, as batch.rss()."""
+    import batch
+    import dss
+    import sharedframes
+    import PIL.Image as Image
+    d = dss.DSS()
+    d.getWCS(fitsfile)
+    with sharedframes.attach(desc) as frame:
+        a = frame['grey']
+        grey = Image.frombuffer('L', (a.shape[1], a.shape[0]), a, 'raw', 'L', 0, 1)
+        try:
+            renderMask(m, d, frame['data'], origin, grey, find_candidates, sweep,
+                       simulate=simulate)
+        finally:
+            # the image maps the shared buffer, which is closed on exit
+            del a, grey
+    return batch.rss()
+
+def maskPage(m, guider_gifout, candidates=()):
+    """Returns the HTML page for mask m"""
+    doc = []
+    doc.append('<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2//EN">\n')
+    doc.append('<HTML>\n<HEAD>\n<TITLE>%s</TITLE>\n</HEAD>\n' % html.escape(m.name))
+    doc.append('<BODY BGCOLOR="#FFFFFF">\n')
+    doc.append(maskFragment(m, guider_gifout, candidates))
+    doc.append('</BODY></HTML>')
+    return ''.join(doc)
+
+def maskFragment(m, guider_gifout, candidates=()):
+    """Returns the body of the HTML page for mask m: mask coordinates,
+    guider image, guide stars and candidates.  Text from the mask file
+    is escaped."""
+    esc = lambda v: html.escape(str(v))
+    dec2 = starlist.signedDec(m.dec)
+    doc = []
+    doc.append('<H1 align="center">%s</H1>\n' % esc(m.name))
+    doc.append('<H3 align="center">Mask Coordinates</H3>\n')
+    doc.append('<center><TABLE border=1 cellpadding=4 cellspacing=1 width="95%">\n')
+    doc.append('<center><TABLE border=1 cellpadding=4 cellspacing=1 \
+    width="95%"><TR Align=center> <TH ColSpan=1 \
+    bgcolor="#B0C4DE">RA</TH><TH ColSpan=1 \
+    bgcolor="#B0C4DE">DEC</TH><TH ColSpan=1 \
+    bgcolor="#B0C4DE">Equinox</TH><TH ColSpan=1 \
+    bgcolor="#B0C4DE">PA</TH></TR>\n')
+    doc.append('<TR><TD Align="center"  bgcolor="#E0F4FF">%s</TD>\n' % esc(m.ra))
+    doc.append('<TD Align="center"  bgcolor="#E0F4FF">%s</TD>\n' % esc(dec2))
+    doc.append('<TD Align="center"  bgcolor="#E0F4FF">%4.1f</TD>\n' % m.equinox)
+    doc.append('<TD Align="center"  bgcolor="#E0F4FF">%3.1f</TD>\n' % m.pa)
+    doc.append('</TR>\n</TABLE><P>\n</center>\n')
+    doc.append('<H3 align="center">Guider Image</H3>\n')
+    doc.append('<center><IMG src="%s" height="320" \
+    width="320" alt="%s"></center>\n' % (esc(guider_gifout), esc(guider_gifout)))
+    doc.append('<H3 align="center">Guider Stars</H3>\n')
+    doc.append('<center>\n')
+    doc.append('Applied offsets: ')
+    doc.append('&Delta;X=%+d, ' % offset_x)
+    doc.append('&Delta;Y=%+d'   % offset_y)
+    doc.append('</center><p>\n')
+
+    doc.append('<center><TABLE border=1 cellpadding=4 cellspacing=1 \
+    width="95%"> <TR Align="center"> <TH ColSpan=1 \
+    bgcolor="#B0C4DE">ID</TH><TH ColSpan=1 \
+    bgcolor="#B0C4DE">RA</TH><TH ColSpan=1 bgcolor="#B0C4DE">DEC</TH><TH \
+    ColSpan=1 bgcolor="#B0C4DE">Equinox</TH><TH ColSpan=1 \
+    bgcolor="#B0C4DE">Mag</TH><TH ColSpan=1 bgcolor="#B0C4DE">Band</TH><TH ColSpan=1 \
+    bgcolor="#B0C4DE">xTV</TH><TH ColSpan=1 bgcolor="#B0C4DE">yTV</TH></TR>\n')
+    # mark guider stars
+    for gs in m.guideStars:
+        doc.append('<TR><TD Align="center"  bgcolor="#E0F4FF">%s</TD>\n' % esc(gs.id))
+        doc.append('<TD Align="center"  bgcolor="#E0F4FF">%s</TD>\n' % esc(gs.ra))
+        doc.append('<TD Align="center"  bgcolor="#E0F4FF">%s</TD>\n' % esc(gs.dec))
+        doc.append('<TD Align="center"  bgcolor="#E0F4FF">%4.1f</TD>\n' % gs.equinox)
+        doc.append('<TD Align="center"  bgcolor="#E0F4FF">%2.1f</TD>\n' % gs.magnitude)
+        doc.append('<TD Align="center"  bgcolor="#E0F4FF">%s</TD>\n' % esc(gs.passband))
+        doc.append('<TD Align="center"  bgcolor="#E0F4FF">%d</TD>\n' % round(gs.xTV))
+        doc.append('<TD Align="center"  bgcolor="#E0F4FF">%d</TD></TR>\n' % round(gs.yTV))
+
+    doc.append('</TABLE></center><P>')
+
+    if candidates:
+        doc.append('<H3 align="center">Guide Star Candidates (DSS)</H3>\n')
+        doc.append('<center><TABLE border=1 cellpadding=4 cellspacing=1 \
+    width="95%"> <TR Align="center"> <TH ColSpan=1 \
+    bgcolor="#B0C4DE">Rank</TH><TH ColSpan=1 \
+    bgcolor="#B0C4DE">RA</TH><TH ColSpan=1 bgcolor="#B0C4DE">DEC</TH><TH \
+    ColSpan=1 bgcolor="#B0C4DE">Flux (ADU)</TH><TH ColSpan=1 \
+    bgcolor="#B0C4DE">Isolation (")</TH></TR>\n')
+        for c in candidates:
+            doc.append('<TR><TD Align="center"  bgcolor="#E0F4FF">C%d</TD>\n' % c.rank)
+            doc.append('<TD Align="center"  bgcolor="#E0F4FF">%s</TD>\n' % c.ra)
+            doc.append('<TD Align="center"  bgcolor="#E0F4FF">%s</TD>\n' % c.dec)
+            doc.append('<TD Align="center"  bgcolor="#E0F4FF">%.0f</TD>\n' % c.flux)
+            doc.append('<TD Align="center"  bgcolor="#E0F4FF">%.0f</TD></TR>\n' % min(c.isolation, 999))
+        doc.append('</TABLE></center><P>')
+    return ''.join(doc)
+
 def to_jpg(data):# Clip data to brightness limits
     data[data > vmax] = vmax
     data[data < vmin] = vmin
@@ -238,23 +706,27 @@ def to_jpg(data):# Clip data to brightness limits
     return(image)
 
 if __name__ == '__main__':
-    import os
-    import sys
-    import dss
-    import math
-    import re
     import getopt
 
-    usage = "Usage: "+sys.argv[0]+" [-h] [-d] filename .. filenameN"
+    usage = "Usage: "+sys.argv[0]+" [-h] [-D] [-n] [-S start,stop,step] [-T] [-Z] [-j jobs] [-m megabytes] [-e exportdir] [-F format] [-I source] filename .. filenameN"
 
     try:
-        optlist, args = getopt.getopt(sys.argv[1:], 'hD')
+        optlist, args = getopt.getopt(sys.argv[1:], 'hDnS:TZj:m:e:F:I:')
     except getopt.GetoptError as err:
         print(err)
         print(usage)
         sys.exit(2)
 
     debug = True
+    find_candidates = True
+    sweep = None
+    simulate = False
+    zoom = False
+    jobs = 1
+    memory_limit = 256
+    exportdir = None
+    export_format = 'auto'
+    source_spec = None
     for o,a in optlist:
         if o == "-h":
             print(usage)
@@ -262,18 +734,60 @@ if __name__ == '__main__':
         elif o in "-D":
             print("DEBUG mode enabled")
             debug = True
+        elif o == "-n":
+            find_candidates = False
+        elif o == "-S":
+            try:
+                sweep = paRange(a)
+            except ValueError as err:
+                print("Bad PA range %s: %s" % (a, err))
+                print(usage)
+                sys.exit(2)
+        elif o == "-T":
+            simulate = True
+        elif o == "-Z":
+            zoom = True
+        elif o == "-j":
+            jobs = int(a)
+        elif o == "-m":
+            memory_limit = float(a)
+        elif o == "-e":
+            exportdir = a
+        elif o == "-F":
+            export_format = a
+        elif o == "-I":
+            source_spec = a
         else:
             assert False, "unhandled option"
-        
+
+    # heavy modules (astropy, numpy, PIL) are only needed from here on
+    import batch
+    import PIL.Image as Image
+
+    source = None
+    if source_spec:
+        import imagesource
+        try:
+            source = imagesource.fromSpec(source_spec)
+        except ValueError as err:
+            print(err)
+            print(usage)
+            sys.exit(2)
+
+    exporter = None
+    if exportdir:
+        import export
+        try:
+            exporter = export.Exporter(exportdir, export_format)
+        except ValueError as err:
+            print(err)
+            print(usage)
+            sys.exit(2)
+
     mlist = args
     slf = open('starlist', 'w')
-    base_path = Path(__file__).parent
-    fontpath = (base_path / "Fonts")
+    font = loadFont()
 
-    guider_scale = 0.207           # guider camera scale arcsec/pix
-    guider_ccd = [212, 212]        # guider camera size in arcsec
-    offset_x = 13                  # offset in X
-    offset_y = -2                  # offset in Y
     print("Adopted TV offsets are dX=%+d and dY=%+d\n" % (offset_x,offset_y))
     
     # build html for master guider image list
@@ -282,7 +796,7 @@ if __name__ == '__main__':
     gdoc.append('<HTML>\n<HEAD>\n<TITLE>Guider Images</TITLE>\n</HEAD>\n')
     gdoc.append('<BODY BGCOLOR="#FFFFFF">\n<H1>Guider Images</H1>\n')
     gdoc.append('<OL type="square">\n<OL type="square">')
-    dss = dss.DSS()
+    plates = {}
     for ml in mlist:
         input = ml
         # make mask instanace
@@ -295,148 +809,105 @@ if __name__ == '__main__':
             print(err)
             sys.exit(1)
 
-        # set output file names
-        output = m.name.strip()
-
-        # remove spaces from name...
-        output = re.sub( '\s', '_', output)
-        fitsout = output+'_dss.fits'
-        gifout = output+'_dss.gif'
-        guider_gifout = output+'_guider_dss.gif'
-        htmlout = output+'_dss.html'
-        
         # add mask name to guider master list
-        gdoc.append('<LI><A HREF="%s">%s</A>' % (htmlout, m.name))
+        output = outputName(m)
+        gdoc.append('<LI><A HREF="%s">%s</A>' % (output+'_dss.html', m.name))
+        if sweep:
+            gdoc.append(' (<A HREF="%s">PA sweep</A>)' % (output+'_pasweep.png'))
+        if simulate:
+            gdoc.append(' (<A HREF="%s">guider TV</A>)' % (output+'_guider_tv.png'))
+        if zoom:
+            gdoc.append(' (<A HREF="%s">zoom</A>)' % (output+'_zoom.html'))
         
         # build starlist
-        # Modified by DKM 2009-03-30: Added PA info
-        sra = m.ra.split(':')
-        sdec = m.dec.split(':')
-        srah = int(sra[0])
-        sram = sra[1]
-        sras = sra[2]
-        sdech = sdec[0]
-        sdecm = sdec[1]
-        sdecs = sdec[2]
-        spa = float(m.pa)
-
-        # determine whether the DEC is + or -.  NOTE: this is
-        # necessary because simply printing the DEC in %+03i format
-        # will yield "+00" for -1 < Dec < 0!
-        mobj = re.match( "^-", sdech)
-        if mobj:
-            sign = '-'
-        else:
-            sign = '+'
-        adech = abs(int(sdech))
-
-        # Sky's got no love for a negative PA
-        if spa < 0:
-            spa += 360
-        seqnx = str(m.equinox).split('.')[0]
-        targname = m.name[:16]
-        slist = (targname,srah,sram,sras,sign,adech,sdecm,sdecs,seqnx,spa)
-        sformat = '%-16s  %02i %s %s %s%02i %s %s %s rotdest=%.2f rotmode=pa\n'
-        print("  "+sformat % slist)
-        slf.write(sformat % slist)
-
-        # generate a new Dec string which has +/-
-        dec2 = '%s%02i:%s:%s' % (sign,adech,sdecm,sdecs)
-        
+        sline = starlist.formatEntry(m)
+        print("  "+sline)
+        slf.write(sline)
+
+        # masks on the same guider field are rendered from one DSS frame
+        plates.setdefault((m.guider_ra, m.guider_dec), []).append(m)
+    slf.close()
+
+    if jobs > 1:
+        import sharedframes
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=jobs)
+        frames = sharedframes.SharedFrames(maxframes=shared_frames)
+        pending = []
+
+        def rendered(m, key, fut):
+            # runs in the parent as each mask's render completes
+            if not fut.cancelled() and fut.exception() is None:
+                current, peak = fut.result()
+                line = "  %s memory: %s, %.1f MB shared" % (m.name.strip(),
+                       engine.memoryReport(), frames.nbytes()/2.0**20)
+                if peak is not None:
+                    line += ", worker rss high-water %.1f MB" % (peak/2.0**20)
+                print(line)
+            frames.release(key)
+    failed = False
+
+    # frames are fetched and decoded ahead of rendering, within the
+    # memory ceiling, and closed as soon as their masks are rendered
+    fitsnames = dict((key, outputName(group[0])+'_dss.fits')
+                     for key, group in plates.items())
+    engine = batch.FrameEngine(
+        lambda key: batch.loadFrame(key, fitsnames[key], view_radius, source=source),
+        limit=memory_limit*2**20, prefetch=max(2, jobs))
+    try:
         # get DSS image, draw guider, mark stars
         # Note: Assumed that DSS images are from 2nd generation red images
         # which are scanned at a resolution of 1"/pix.
-        gra = m.guider_ra
-        gdec = m.guider_dec
-        try:
-            fits_file = dss.getDSSImage(gra, gdec, fitsout)
-        except IOError as error:
-            print(error)
-            sys.exit()
-        dss.getWCS(fits_file)
-        imfits2pil = fits2pil.arrayToGreyImage(fits_file[0].data)
-        im = imfits2pil.convert('RGB')
-        imskypa = dss.skyPA()
-        rotate = 91.4 - m.pa
-        gxy = (im.size[0]/2, im.size[1]/2)
-        im = im.rotate(rotate, Image.BICUBIC)
-        draw = ImageDraw.Draw(im)
-        font=ImageFont.load(fontpath / "helvR08.pil")
-        #draw.setfont(font)
-        #draw.setink(colors['black'])
-        draw.line((gxy[0]-106, gxy[1]+23, gxy[0]+106, gxy[1]+23), fill=colors['black'])
-        drawbox(draw, gxy[0], gxy[1], 212, 212)
-        for gs in m.guideStars:
-            gsx, gsy = dss.rd2xy(gs.ra, gs.dec)
-            radrot = rotate*(math.pi/180.0)
-            gsrxy = rotxy(gsx - gxy[0], gsy - gxy[1], radrot)
-            gsrxy[0] = gsrxy[0] + gxy[0]
-            gsrxy[1] = im.size[1] - (gxy[1] + gsrxy[1])
-            #draw.setink(colors['red'])
-            label = gs.id.upper()
-            draw.text((gsrxy[0]+10, gsrxy[1]-10), label, font = font, fill=colors['red'])
-            drawcircle(draw, gsrxy[0], gsrxy[1], 10)
-        #draw.setink(colors['blue'])
-        drawcompass(draw, gxy[0]-116, gxy[1]-116, m.pa-imskypa, fill=colors['blue'])
-        #font=ImageFont.load(fontpath+"/helvR12.pil")
-        #draw.setfont(font)
-        im = im.crop((gxy[0]-160, gxy[1]-160, gxy[0]+160, gxy[1]+160))
-        im.save(guider_gifout)
-        
-        # build html for guider image
-        doc = []
-        doc.append('<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2//EN">\n')
-        doc.append('<HTML>\n<HEAD>\n<TITLE>%s</TITLE>\n</HEAD>\n' % m.name)
-        doc.append('<BODY BGCOLOR="#FFFFFF">\n')
-        doc.append('<H1 align="center">%s</H1>\n' % m.name)
-        doc.append('<H3 align="center">Mask Coordinates</H3>\n')
-        doc.append('<center><TABLE border=1 cellpadding=4 cellspacing=1 width="95%">\n')
-        doc.append('<center><TABLE border=1 cellpadding=4 cellspacing=1 \
-        width="95%"><TR Align=center> <TH ColSpan=1 \
-        bgcolor="#B0C4DE">RA</TH><TH ColSpan=1 \
-        bgcolor="#B0C4DE">DEC</TH><TH ColSpan=1 \
-        bgcolor="#B0C4DE">Equinox</TH><TH ColSpan=1 \
-        bgcolor="#B0C4DE">PA</TH></TR>\n')
-        doc.append('<TR><TD Align="center"  bgcolor="#E0F4FF">%s</TD>\n' % m.ra)
-        doc.append('<TD Align="center"  bgcolor="#E0F4FF">%s</TD>\n' % dec2)
-        doc.append('<TD Align="center"  bgcolor="#E0F4FF">%4.1f</TD>\n' % m.equinox)
-        doc.append('<TD Align="center"  bgcolor="#E0F4FF">%3.1f</TD>\n' % m.pa)
-        doc.append('</TR>\n</TABLE><P>\n</center>\n')
-        doc.append('<H3 align="center">Guider Image</H3>\n')
-        doc.append('<center><IMG src="%s" height="320" \
-        width="320" alt="%s"></center>\n' % (guider_gifout, guider_gifout))
-        doc.append('<H3 align="center">Guider Stars</H3>\n')
-        doc.append('<center>\n')
-        doc.append('Applied offsets: ')
-        doc.append('&Delta;X=%+d, ' % offset_x)
-        doc.append('&Delta;Y=%+d'   % offset_y)
-        doc.append('</center><p>\n')
-
-        doc.append('<center><TABLE border=1 cellpadding=4 cellspacing=1 \
-        width="95%"> <TR Align="center"> <TH ColSpan=1 \
-        bgcolor="#B0C4DE">ID</TH><TH ColSpan=1 \
-        bgcolor="#B0C4DE">RA</TH><TH ColSpan=1 bgcolor="#B0C4DE">DEC</TH><TH \
-        ColSpan=1 bgcolor="#B0C4DE">Equinox</TH><TH ColSpan=1 \
-        bgcolor="#B0C4DE">Mag</TH><TH ColSpan=1 bgcolor="#B0C4DE">Band</TH><TH ColSpan=1 \
-        bgcolor="#B0C4DE">xTV</TH><TH ColSpan=1 bgcolor="#B0C4DE">yTV</TH></TR>\n')
-        # mark guider stars
-        for gs in m.guideStars:
-            doc.append('<TR><TD Align="center"  bgcolor="#E0F4FF">%s</TD>\n' % gs.id)
-            doc.append('<TD Align="center"  bgcolor="#E0F4FF">%s</TD>\n' % gs.ra)
-            doc.append('<TD Align="center"  bgcolor="#E0F4FF">%s</TD>\n' % gs.dec)
-            doc.append('<TD Align="center"  bgcolor="#E0F4FF">%4.1f</TD>\n' % gs.equinox)
-            doc.append('<TD Align="center"  bgcolor="#E0F4FF">%2.1f</TD>\n' % gs.magnitude)
-            doc.append('<TD Align="center"  bgcolor="#E0F4FF">%s</TD>\n' % gs.passband)
-            doc.append('<TD Align="center"  bgcolor="#E0F4FF">%d</TD>\n' % round(gs.xTV))
-            doc.append('<TD Align="center"  bgcolor="#E0F4FF">%d</TD></TR>\n' % round(gs.yTV))
-
-        doc.append('</TABLE></center><P>')
+        for frame in engine.frames(plates):
+            group = plates[frame.key]
+            with frame:
+                if zoom:
+                    import tiles
+                    tiledir = os.path.splitext(frame.fitsfile)[0]+'_tiles'
+                    info = tiles.buildPyramid(frame.fitsfile, tiledir, workers=max(jobs, 4))
+                    for m in group:
+                        zoomdoc = open(outputName(m)+'_zoom.html', 'w')
+                        zoomdoc.write(tiles.viewerPage(m, frame.plate, info, tiledir))
+                        zoomdoc.close()
+                if jobs <= 1:
+                    for m in group:
+                        renderMask(m, frame.plate, frame.data, frame.origin,
+                                   Image.fromarray(frame.grey),
+                                   find_candidates, sweep, font, simulate)
+                        if exporter:
+                            exporter.addMask(m, frame.plate)
+                        print("  %s memory: %s" % (m.name.strip(), engine.memoryReport()))
+                    continue
+                desc = frames.publish(frame.key, {'data': frame.data, 'grey': frame.grey},
+                                      refs=len(group))
+            for m in group:
+                fut = pool.submit(renderWorker, m, frame.fitsfile, desc, frame.origin,
+                                  find_candidates, sweep, simulate)
+                fut.add_done_callback(functools.partial(rendered, m, frame.key))
+                pending.append((m, fut))
+                if exporter:
+                    exporter.addMask(m, frame.plate)
+        if jobs > 1:
+            for m, fut in pending:
+                try:
+                    fut.result()
+                except Exception as err:
+                    print('ERROR: Unable to render mask %s: %s' % (m.file, err))
+                    failed = True
+    except IOError as error:
+        print(error)
+        sys.exit(1)
+    finally:
+        if jobs > 1:
+            # let running renders finish before their frames are freed
+            pool.shutdown(cancel_futures=True)
+            frames.close()
+    if failed:
+        sys.exit(1)
+    if exporter:
+        exporter.close()
+        print("Exported tables to %s" % ", ".join(exporter.path(t) for t in export.tables))
 
-        doc.append('</BODY></HTML>')
-        maskdoc = open(htmlout, 'w')
-        for l in doc:
-            maskdoc.write(l)
-        maskdoc.close()
     gdoc.append('<LI><A HREF="starlist">starlist</A>\n')
     gdoc.append('</OL>\n</OL>\n</BODY> </HTML>')
     guiderdoc = open('guider_images.html', 'w')
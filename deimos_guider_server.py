@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+"""HTTP service that renders DEIMOS guider views for DSIMULATOR files,
+keeping plate solutions, decoded DSS frames and fonts warm between
+requests.
+
+Usage:
+        deimos_guider_server [-p port] [-w workers] [-c cachedir]
+                             [-f frames] [-s source] [-n]
+
+Switches:
+        -p = TCP port to listen on (default 8765, localhost only)
+        -w = number of worker threads serving requests (default 4)
+        -c = directory for downloaded DSS images (default current dir)
+        -f = number of decoded DSS frames kept in memory (default 16)
+        -s = where to get DSS images that are not cached yet, as for
+             deimos_guider_dss -I (default mast)
+        -n = do not search the DSS frames for guide star candidates
+
+Endpoints:
+        POST /render    body is the DSIMULATOR .out file; returns JSON
+                        with the mask name, the starlist line, the guider
+                        image (base64 GIF) and the HTML fragment of the
+                        mask page with the image inlined.  ?candidates=0
+                        skips the search.  Bodies over 4 MB get 413.
+        GET  /metrics   request counts, p50/p99 latency and cache sizes
+
+Examples:
+        1) Start the service and render a mask:
+                deimos_guider_server -p 8765 &
+                curl --data-binary @mask1.out localhost:8765/render
+
+Modification History:
+        2026-Oct-19             Original version
+"""
+
+import base64
+import collections
+import io
+import json
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+import getopt
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import deimos_guider_dss as guider
+import starlist
+
+# largest mask file accepted by /render, in bytes; DSIMULATOR files are
+# a few tens of kB
+max_request = 4*2**20
+
+class LRUCache:
+    """A small thread-safe least-recently-used cache"""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+            self.misses += 1
+            return None
+
+    def peek(self, key):
+        """Returns the value of key, or None, without counting a hit or
+        miss or refreshing it"""
+        with self.lock:
+            return self.data.get(key)
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.data), "maxsize": self.maxsize,
+                    "hits": self.hits, "misses": self.misses}
+
+class Frame:
+    def __init__(self, data, grey, origin):
+        self.data = data
+        self.grey = grey
+        self.origin = origin
+        self.sources = None
+
+class Renderer:
+    def __init__(self, cachedir='.', frames=16, plates=256,
+                 find_candidates=True, source=None):
+        self.cachedir = cachedir
+        self.source = source
+        self.find_candidates = find_candidates
+        self.plates = LRUCache(plates)
+        self.frames = LRUCache(frames)
+        # a fixed set of locks striped by key, so concurrent requests for
+        # one field decode it once without keeping a lock per field seen
+        self.locks = [threading.Lock() for i in range(64)]
+        self.font = guider.loadFont()
+        # pay for the heavy imports once, before the first request
+        import dss, fits2pil, findstars
+
+    def fitsName(self, m):
+        """Returns the cached DSS image name for the guider field of m;
+        masks on the same field share one image"""
+        key = re.sub(r'[^0-9A-Za-z.+-]', '_', '%s_%s' % (m.guider_ra, m.guider_dec))
+        return os.path.join(self.cachedir, 'dss_%s.fits' % key)
+
+    def lock(self, key):
+        return self.locks[hash(key) % len(self.locks)]
+
+    def plate(self, fitsfile):
+        import dss
+        d = self.plates.get(fitsfile)
+        if d is None:
+            d = dss.DSS()
+            d.getWCS(fitsfile)
+            self.plates.put(fitsfile, d)
+        return d
+
+    def frame(self, m):
+        """Returns (DSS plate solution, decoded Frame) for the guider
+        field of m, fetching and decoding the image only once"""
+        import dss
+        import fits2pil
+        fitsfile = self.fitsName(m)
+        f = self.frames.get(fitsfile)
+        if f is None:
+            with self.lock(fitsfile):
+                f = self.frames.peek(fitsfile)
+                if f is None:
+                    with dss.DSS(self.source).getDSSImage(m.guider_ra, m.guider_dec, fitsfile) as hdul:
+                        data, origin = dss.centralSection(hdul, guider.view_radius)
+                    f = Frame(data, fits2pil.arrayToGreyImage(data), origin)
+                    self.frames.put(fitsfile, f)
+        return self.plate(fitsfile), f
+
+    def render(self, text, find_candidates=True):
+        """Renders the guider view of the DSIMULATOR file contents text"""
+        import findstars
+        m = guider.Mask()
+        m.parseLines(io.StringIO(text.replace('\r\n', '\n')).readlines())
+        d, f = self.frame(m)
+        candidates = []
+        if self.find_candidates and find_candidates:
+            if f.sources is None:
+                f.sources = findstars.findSources(f.data, origin=f.origin)
+            gxy = (f.origin[0] + f.data.shape[1]/2, f.origin[1] + f.data.shape[0]/2)
+            candidates = findstars.rankCandidates(f.sources, d, gxy,
+                                                  guider.guiderRotation(m),
+                                                  box=guider.guider_ccd[0])
+        im = guider.guiderImage(m, d, f.grey, candidates, self.font, f.origin)
+        buf = io.BytesIO()
+        im.save(buf, 'GIF')
+        image = base64.b64encode(buf.getvalue()).decode('ascii')
+        uri = 'data:image/gif;base64,' + image
+        return {"name": m.name.strip(),
+                "starlist": starlist.formatEntry(m),
+                "image": image,
+                "html": guider.maskFragment(m, uri, candidates)}
+
+class Metrics:
+    def __init__(self, window=10000):
+        self.latencies = collections.deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def record(self, seconds, ok):
+        with self.lock:
+            self.requests += 1
+            if not ok:
+                self.errors += 1
+            self.latencies.append(seconds)
+
+    def summary(self):
+        with self.lock:
+            lat = sorted(self.latencies)
+            out = {"requests": self.requests, "errors": self.errors}
+        for name, q in (("p50_ms", 0.50), ("p99_ms", 0.99)):
+            if lat:
+                out[name] = 1000.0*lat[min(len(lat) - 1, int(q*len(lat)))]
+            else:
+                out[name] = None
+        return out
+
+class Handler(BaseHTTPRequestHandler):
+    def reply(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/metrics':
+            self.reply(404, {"error": "unknown path %s" % url.path})
+            return
+        body = self.server.metrics.summary()
+        body["plates"] = self.server.renderer.plates.stats()
+        body["frames"] = self.server.renderer.frames.stats()
+        body["workers"] = self.server.workers
+        self.reply(200, body)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/render':
+            self.reply(404, {"error": "unknown path %s" % url.path})
+            return
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            try:
+                n = int(self.headers.get('Content-Length', 0))
+            except ValueError:
+                n = -1
+            if n < 0:
+                self.reply(400, {"error": "bad Content-Length"})
+                return
+            if n > max_request:
+                # answer without reading the body, and drop the connection
+                self.close_connection = True
+                self.reply(413, {"error": "mask file larger than %d bytes" % max_request})
+                return
+            text = self.rfile.read(n).decode('utf-8', 'replace')
+            qs = parse_qs(url.query)
+            find = qs.get('candidates', ['1'])[0] not in ('0', 'no', 'false')
+            try:
+                body = self.server.renderer.render(text, find)
+            except (ValueError, IndexError) as err:
+                self.reply(400, {"error": "bad mask file: %s" % err})
+                return
+            except IOError as err:
+                self.reply(502, {"error": "DSS image unavailable: %s" % err})
+                return
+            except Exception as err:
+                self.log_error("render failed: %r", err)
+                traceback.print_exc()
+                self.reply(500, {"error": "render failed: %s" % err})
+                return
+            self.reply(200, body)
+            ok = True
+        finally:
+            self.server.metrics.record(time.perf_counter() - t0, ok)
+
+class GuiderServer(HTTPServer):
+    """HTTPServer handing each connection to a fixed pool of threads"""
+    def __init__(self, address, renderer, workers=4):
+        HTTPServer.__init__(self, address, Handler)
+        self.renderer = renderer
+        self.metrics = Metrics()
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.pool.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    usage = "Usage: "+sys.argv[0]+" [-h] [-p port] [-w workers] [-c cachedir] [-f frames] [-s source] [-n]"
+
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'hp:w:c:f:s:n')
+    except getopt.GetoptError as err:
+        print(err)
+        print(usage)
+        sys.exit(2)
+
+    port = 8765
+    workers = 4
+    cachedir = '.'
+    frames = 16
+    source = None
+    find_candidates = True
+    for o,a in optlist:
+        if o == "-h":
+            print(usage)
+            sys.exit(1)
+        elif o == "-p":
+            port = int(a)
+        elif o == "-w":
+            workers = int(a)
+        elif o == "-c":
+            cachedir = a
+        elif o == "-f":
+            frames = int(a)
+        elif o == "-s":
+            import imagesource
+            try:
+                source = imagesource.fromSpec(a)
+            except ValueError as err:
+                print(err)
+                print(usage)
+                sys.exit(2)
+        elif o == "-n":
+            find_candidates = False
+        else:
+            assert False, "unhandled option"
+
+    renderer = Renderer(cachedir, frames=frames, find_candidates=find_candidates,
+                        source=source)
+    server = GuiderServer(('127.0.0.1', port), renderer, workers)
+    print("Serving guider views on http://127.0.0.1:%d/render" % port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -5,13 +5,17 @@ a Keck-formatted starlist.
 
 Usage:
         Change to directory with your mask designs
-        deimos_starlist [-D] [file1 .. fileN]
+        deimos_starlist [-D] [-j] [-o output] [-w workers] [file1 .. fileN]
 
 Switches:
         -D = debug mode; print each input line as it is processed
+        -j = write one JSON record per mask instead of starlist lines
+        -o = output file ("-" for standard output); default "starlist"
+        -w = number of parallel reader threads; default 8
 
 Args:
-        fileN = DSIMULATOR output file list
+        fileN = DSIMULATOR output files, or directories containing
+                .out files
        
 Output: 
 	Keck-formatted starlist file, "starlist"
@@ -20,7 +24,7 @@ External modules needed:
         None
 
 Version:
-	Tested in Python 2.4.6 on Solaris10
+	Python 3
 
 Examples:
         1) Generate a starlist for DSIMULATOR files mask1.out and
@@ -34,6 +38,9 @@ Examples:
         3) Generate a starlist for all DSIMULATOR files *.out:
                 python deimos_starlist.py *.out
 
+        4) Write JSON records for every mask in an archive directory:
+                python deimos_starlist.py -j -o masks.jsonl archive/
+
 Modification History:
         2003-Mar-28     DKM     Original version
         2012-Nov-11     GDW     Fixed print format to handle -10<Dec<0
@@ -50,114 +57,71 @@ Modification History:
                                 - Added offsets to printout
         2013-Dec-20     GDW     - Added debug mode switch
 	2015-Feb-19	jlyke	-Adapted for just starlist output
+        2026-Oct-19             - Python 3; share the starlist code with
+                                deimos_guider_dss (module starlist), read
+                                only the header lines, scan directories
+                                in parallel, add JSON record output
                                 """
 
-import math
-import re
-
-class Mask:
-    def __init__(self):
-        self.selectedObjects = []
-        self.alignmentStars = []
-        self.guideStars = []
-        self.debug = False
-
-    def readMaskFile(self, maskfile):
-
-        print "Processing file %s" % maskfile
-
-        self.file = maskfile
-        f = open(self.file,"r")
-        l = f.readlines()
-        f.close()
-
-        # parse the second line of the file, which contains the field
-        # name, field center, and equinox...
-        if self.debug:
-            print l[1]
-        pattern = "^(.+)\s+(\d+:\d+:\d+\.\d+)\s+(\S*\d+:\d+:\d+\.\d+)\s+(\S+)\s+PA=\s*(\S*)\s+##"
-        mobj = re.match( pattern, l[1])
-        if mobj:
-            self.name = mobj.group(1)
-            self.ra = mobj.group(2)
-            self.dec = mobj.group(3)
-            self.equinox = float(mobj.group(4))
-            self.pa = float(mobj.group(5))
-        else:
-            print '  ERROR: line 2 does not match expected format -- abort!'
-            sys.exit(1)
+import json
+import sys
+import getopt
+import starlist
 
 
 if __name__ == '__main__':
-    import os, sys, glob
-    import math
-    import re
-    import getopt
-
-    usage = "Usage: "+sys.argv[0]+" [-h] [-d] filename .. filenameN"
+    usage = "Usage: "+sys.argv[0]+" [-h] [-D] [-j] [-o output] [-w workers] filename .. filenameN"
 
     try:
-        optlist, args = getopt.getopt(sys.argv[1:], 'hD')
-    except getopt.GetoptError,err:
+        optlist, args = getopt.getopt(sys.argv[1:], 'hDjo:w:')
+    except getopt.GetoptError as err:
         print(err)
-        print usage
+        print(usage)
         sys.exit(2)
 
     debug = False
+    records = False
+    output = 'starlist'
+    workers = 8
     for o,a in optlist:
         if o == "-h":
-            print usage
+            print(usage)
             sys.exit(1)
-        elif o in "-D":
-            print "DEBUG mode enabled"
+        elif o == "-D":
+            print("DEBUG mode enabled", file=sys.stderr)
             debug = True
+        elif o == "-j":
+            records = True
+        elif o == "-o":
+            output = a
+        elif o == "-w":
+            workers = int(a)
         else:
             assert False, "unhandled option"
-        
-    mlist = args
-    slf = open('starlist','w')
-
-    for ml in mlist:
-        input = ml
-        # make mask instanace
-        m = Mask()
-        m.debug = debug
-        try:
-            m.readMaskFile(input)
-        except Exception, err:
-            print 'ERROR: Unable to read mask file: '+ml
-            print err
-            sys.exit(1)
 
-        # build starlist
-        # Modified by DKM 2009-03-30: Added PA info
-        sra = m.ra.split(':')
-        sdec = m.dec.split(':')
-        srah = int(sra[0])
-        sram = sra[1]
-        sras = sra[2]
-        sdech = sdec[0]
-        sdecm = sdec[1]
-        sdecs = sdec[2]
-        spa = float(m.pa)
-
-        # determine whether the DEC is + or -.  NOTE: this is
-        # necessary because simply printing the DEC in %+03i format
-        # will yield "+00" for -1 < Dec < 0!
-        mobj = re.match( "^-", sdech)
-        if mobj:
-            sign = '-'
+    # progress goes to stderr when the output itself is on stdout
+    if output == '-':
+        slf = sys.stdout
+        log = sys.stderr
+    else:
+        slf = open(output, 'w')
+        log = sys.stdout
+
+    for ml, h in starlist.scanHeaders(args, workers):
+        if isinstance(h, Exception):
+            print('ERROR: Unable to read mask file: '+ml, file=log)
+            print(h, file=log)
+            sys.exit(1)
+        print("Processing file %s" % ml, file=log)
+        if debug:
+            print(starlist.record(h), file=log)
+        if records:
+            slf.write(json.dumps(starlist.record(h)) + '\n')
         else:
-            sign = '+'
-        adech = abs(int(sdech))
-
-        # Sky's got no love for a negative PA
-        if spa < 0:
-            spa += 360
-        seqnx = str(m.equinox).split('.')[0]
-        targname = m.name[:16]
-        slist = (targname,srah,sram,sras,sign,adech,sdecm,sdecs,seqnx,spa)
-        sformat = '%-16s  %02i %s %s %s%02i %s %s %s rotdest=%.2f rotmode=pa\n'
-        print "  "+sformat % slist
-        slf.write(sformat % slist)
+            line = starlist.formatEntry(h)
+            print("  "+line, file=log)
+            slf.write(line)
+        slf.flush()
 
+    if slf is not sys.stdout:
+        slf.close()
@@ -1,6 +1,11 @@
 # Module: dss
-# - Retrives images from MAST DSS image server (fits or gif)
+# - Retrives images from MAST DSS image server, or from another source
+#   of the imagesource module (local directory, record/replay)
 # - Computes positions from Digital Sky Survey plate fit
+# - Caches plate fits in a JSON sidecar next to each image, read from the
+#   FITS header only
+# - Stores integer images Rice tile-compressed, and reads the central
+#   guider region by decoding only the tiles that overlap it
 # Usage:
 #       >>> import dss
 #       >>> dss = dss.DSS()
@@ -19,55 +24,156 @@
 # DKM 2003-02-13
 
 from math import pi,sin,cos,tan,atan,atan2
+import json
 import os.path
 import angles
-import astropy.io.fits as fits
+
+def wcsFromHeader(header):
+    """Builds the plate solution dictionary from a DSS FITS header"""
+    amdx = []
+    amdy = []
+    for i in range(1,14):
+            amdx.append(float(header["AMDX"+str(i)]))
+            amdy.append(float(header["AMDY"+str(i)]))
+    rah = (float(header["PLTRAH"]) +
+          float(header["PLTRAM"])/60.0 +
+          float(header["PLTRAS"])/3600.0)
+    plate_ra = angles.hrs2rad(rah)
+    if "-" in header["PLTDECSN"]:
+            decsn = -1
+    else:
+            decsn = 1
+    decd = decsn*(float(header["PLTDECD"]) +
+           float(header["PLTDECM"])/60.0 +
+           float(header["PLTDECS"])/3600.0)
+    plate_dec = angles.deg2rad(decd)
+
+    return {
+          "xpoff" : float(header["CNPIX1"]),
+          "ypoff" : float(header["CNPIX2"]),
+          "xpsize" : float(header["XPIXELSZ"]),
+          "ypsize" : float(header["YPIXELSZ"]),
+          "ppo3" : float(header["PPO3"]),
+          "ppo6" : float(header["PPO6"]),
+          "xcoeff" : amdx,
+          "ycoeff" : amdy,
+          "plate_ra" : plate_ra,
+          "plate_dec" : plate_dec,
+          "platescl" : float(header["PLTSCALE"]),
+          "naxis1" : float(header["NAXIS1"]),
+          "naxis2" : float(header["NAXIS2"])
+          }
+
+def sidecarName(fitsfile):
+    """Returns the name of the plate solution sidecar of fitsfile"""
+    return os.path.splitext(fitsfile)[0] + '.wcs.json'
+
+def readWCS(fitsfile):
+    """Returns the plate solution of fitsfile without reading its pixels.
+
+    The solution is taken from the JSON sidecar when it is present and
+    was written for the current file (same size and modification time);
+    otherwise only the FITS header is read and the sidecar is rewritten.
+    A sidecar whose image is no longer on disk is still used; one that
+    cannot be decoded is ignored and rebuilt."""
+    sidecar = sidecarName(fitsfile)
+    try:
+        st = os.stat(fitsfile)
+        stamp = [st.st_size, st.st_mtime]
+    except OSError:
+        stamp = None
+    try:
+        with open(sidecar) as f:
+            cached = json.load(f)
+        if stamp is None or cached.get("source") == stamp:
+            return dict(cached["wcs"])
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        pass
+    import astropy.io.fits as fits
+    with fits.open(fitsfile) as hdulist:
+        wcs = wcsFromHeader(imageHDU(hdulist).header)
+    # write then rename: -j workers may read the sidecar meanwhile
+    tmp = '%s.%d.tmp' % (sidecar, os.getpid())
+    try:
+        with open(tmp, 'w') as f:
+            json.dump({"source": stamp, "wcs": wcs}, f)
+        os.replace(tmp, sidecar)
+    except OSError as err:
+        print("Unable to write %s: %s" % (sidecar, err))
+    return wcs
+
+def imageHDU(hdulist):
+    """Returns the HDU holding the image: the primary HDU of a plain FITS
+    file, or the first tile-compressed image extension"""
+    for hdu in hdulist:
+        if hdu.is_image and hdu.header.get("NAXIS", 0) == 2:
+            return hdu
+    return hdulist[0]
+
+def writeImage(hdulist, output, compress=True, tile=64):
+    """Writes the image of hdulist to output, Rice tile-compressed in
+    tile x tile pixel tiles when the pixels are integers (lossless).
+    Floating point images are written uncompressed.  The file is
+    written under a temporary name and renamed, so an interrupted write
+    never leaves a truncated image in the cache."""
+    import astropy.io.fits as fits
+    hdu = imageHDU(hdulist)
+    if compress and hdu.data is not None and hdu.data.dtype.kind in 'iu':
+        comp = fits.CompImageHDU(hdu.data, hdu.header, compression_type='RICE_1',
+                                 tile_shape=(tile, tile))
+        out = fits.HDUList([fits.PrimaryHDU(), comp])
+    else:
+        out = fits.HDUList([fits.PrimaryHDU(hdu.data, hdu.header)])
+    tmp = '%s.%d.tmp' % (output, os.getpid())
+    try:
+        out.writeto(tmp, overwrite=True)
+        os.replace(tmp, output)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def centralSection(hdulist, halfsize):
+    """Returns (data, origin): the central 2*halfsize square of the image,
+    and the 0-based pixel (x, y) of its first pixel in the full frame.
+
+    Only the rows (plain FITS) or tiles (compressed FITS) that overlap
+    the section are read and decoded."""
+    import numpy as np
+    import astropy.io.fits as fits
+    hdu = imageHDU(hdulist)
+    ny = hdu.header["NAXIS2"]
+    nx = hdu.header["NAXIS1"]
+    x0 = max(0, int(round(nx/2.0 - halfsize)))
+    y0 = max(0, int(round(ny/2.0 - halfsize)))
+    x1 = min(nx, nx - x0)
+    y1 = min(ny, ny - y0)
+    if isinstance(hdu, fits.CompImageHDU):
+        section = hdu.section[y0:y1, x0:x1]
+    else:
+        # plain FITS is memory mapped: slicing only pages in those rows
+        section = hdu.data[y0:y1, x0:x1]
+    return np.array(section), (x0, y0)
 
 class DSS:
-    def __init__(self):
+    def __init__(self, source=None):
+        self.source = source
+        self.compress = True
         self.radeg = 180.0/pi
         self.twopi = 2.0*pi
         self.arcsec_per_radian = 3600.0*self.radeg
 
     def getWCS(self, fitsfile):
-        self.fitsimg = fitsfile[0]
-        #try:
-        #    self.fitsimg = fits.FITS(self.fitsfile, "h")
-        #except IOerror as err:
-        #    print(err)
-        #    return
-        # Make a new wcs dictionary
-        amdx = []
-        amdy = []
-        for i in range(1,14):
-                amdx.append(float(self.fitsimg.header["AMDX"+str(i)]))
-                amdy.append(float(self.fitsimg.header["AMDY"+str(i)]))
-        rah = (float(self.fitsimg.header["PLTRAH"]) +
-              float(self.fitsimg.header["PLTRAM"])/60.0 +
-              float(self.fitsimg.header["PLTRAS"])/3600.0)
-        plate_ra = angles.hrs2rad(rah)
-        if "-" in self.fitsimg.header["PLTDECSN"]:
-                decsn = -1
-        else:
-                decsn = 1
-        decd = decsn*(float(self.fitsimg.header["PLTDECD"]) +
-               float(self.fitsimg.header["PLTDECM"])/60.0 +
-               float(self.fitsimg.header["PLTDECS"])/3600.0)
-        plate_dec = angles.deg2rad(decd)
-
-        self.wcs = {
-              "xpoff" : float(self.fitsimg.header["CNPIX1"]),
-              "ypoff" : float(self.fitsimg.header["CNPIX2"]),
-              "xpsize" : float(self.fitsimg.header["XPIXELSZ"]),
-              "ypsize" : float(self.fitsimg.header["YPIXELSZ"]),
-              "ppo3" : float(self.fitsimg.header["PPO3"]),
-              "ppo6" : float(self.fitsimg.header["PPO6"]),
-              "xcoeff" : amdx,
-              "ycoeff" : amdy,
-              "plate_ra" : plate_ra,
-              "plate_dec" : plate_dec,
-              "platescl" : float(self.fitsimg.header["PLTSCALE"])
-              }
+        """Loads the plate solution from a FITS file name or an HDUList.
+
+        Given a file name only the header is read, and the solution is
+        kept in a JSON sidecar next to the image (see readWCS), so later
+        runs skip FITS I/O altogether.  No reference to an HDUList is
+        kept, so it can be closed as soon as the solution is loaded."""
+        if isinstance(fitsfile, str):
+            self.wcs = readWCS(fitsfile)
+            return
+        self.wcs = wcsFromHeader(imageHDU(fitsfile).header)
         return
 
     def xy2rd(self, xin, yin):
@@ -130,6 +236,79 @@ class DSS:
         dec = angles.dms2sex(angles.rad2deg(dec))
         return ra, dec
 
+    def _amd(self, obx, oby):
+        """Evaluates the plate model and its derivatives at plate
+        position obx, oby (mm); works on scalars and NumPy arrays"""
+        f = (self.wcs["xcoeff"][0]*obx+                 
+             self.wcs["xcoeff"][1]*oby+                 
+             self.wcs["xcoeff"][2]+                     
+             self.wcs["xcoeff"][3]*obx*obx+             
+             self.wcs["xcoeff"][4]*obx*oby+             
+             self.wcs["xcoeff"][5]*oby*oby+             
+             self.wcs["xcoeff"][6]*(obx*obx+oby*oby)+   
+             self.wcs["xcoeff"][7]*obx*obx*obx+         
+             self.wcs["xcoeff"][8]*obx*obx*oby+         
+             self.wcs["xcoeff"][9]*obx*oby*oby+         
+             self.wcs["xcoeff"][10]*oby*oby*oby+             
+             self.wcs["xcoeff"][11]*obx*(obx*obx+oby*oby)+   
+             self.wcs["xcoeff"][12]*obx*(obx*obx+oby*oby)**2)
+
+        fx = (self.wcs["xcoeff"][0]+                     
+              self.wcs["xcoeff"][3]*2.0*obx+             
+              self.wcs["xcoeff"][4]*oby+                 
+              self.wcs["xcoeff"][6]*2.0*obx+             
+              self.wcs["xcoeff"][7]*3.0*obx*obx+         
+              self.wcs["xcoeff"][8]*2.0*obx*oby+         
+              self.wcs["xcoeff"][9]*oby*oby+             
+              self.wcs["xcoeff"][11]*(3.0*obx*obx+oby*oby)+   
+              self.wcs["xcoeff"][12]*(5.0*obx**4 + 6.0*obx**2*oby**2 + oby**4))
+
+        fy = (self.wcs["xcoeff"][1]+                     
+              self.wcs["xcoeff"][4]*obx+                 
+              self.wcs["xcoeff"][5]*2.0*oby+             
+              self.wcs["xcoeff"][6]*2.0*oby+             
+              self.wcs["xcoeff"][8]*obx*obx+             
+              self.wcs["xcoeff"][9]*obx*2.0*oby+         
+              self.wcs["xcoeff"][10]*3.0*oby*oby+        
+              self.wcs["xcoeff"][11]*2.0*obx*oby+        
+              self.wcs["xcoeff"][12]*(4.0*obx**3*oby + 4.0*obx*oby**3))
+
+        g = (self.wcs["ycoeff"][0]*oby+                 
+             self.wcs["ycoeff"][1]*obx+                 
+             self.wcs["ycoeff"][2]+                     
+             self.wcs["ycoeff"][3]*oby*oby+             
+             self.wcs["ycoeff"][4]*oby*obx+             
+             self.wcs["ycoeff"][5]*obx*obx+             
+             self.wcs["ycoeff"][6]*(obx*obx+oby*oby)+   
+             self.wcs["ycoeff"][7]*oby*oby*oby+         
+             self.wcs["ycoeff"][8]*oby*oby*obx+         
+             self.wcs["ycoeff"][9]*oby*obx*obx+         
+             self.wcs["ycoeff"][10]*obx*obx*obx+             
+             self.wcs["ycoeff"][11]*oby*(obx*obx+oby*oby)+   
+             self.wcs["ycoeff"][12]*oby*(obx*obx+oby*oby)**2)
+
+        gx = (self.wcs["ycoeff"][1]+                     
+              self.wcs["ycoeff"][4]*oby+                 
+              self.wcs["ycoeff"][5]*2.0*obx+             
+              self.wcs["ycoeff"][6]*2.0*obx+             
+              self.wcs["ycoeff"][8]*oby*oby+             
+              self.wcs["ycoeff"][9]*oby*2.0*obx+         
+              self.wcs["ycoeff"][10]*3.0*obx*obx+        
+              self.wcs["ycoeff"][11]*2.0*obx*oby+        
+              self.wcs["ycoeff"][12]*(4.0*obx**3*oby + 4.0*obx*oby**3))
+
+        gy = (self.wcs["ycoeff"][0]+                     
+              self.wcs["ycoeff"][3]*2.0*oby+             
+              self.wcs["ycoeff"][4]*obx+                 
+              self.wcs["ycoeff"][6]*2.0*oby+             
+              self.wcs["ycoeff"][7]*3.0*oby*oby+         
+              self.wcs["ycoeff"][8]*2.0*oby*obx+         
+              self.wcs["ycoeff"][9]*obx*obx+             
+              self.wcs["ycoeff"][11]*(3.0*oby*oby+obx*obx)+   
+              self.wcs["ycoeff"][12]*(5.0*oby**4 + 6.0*obx**2*oby**2 + obx**4))
+
+        return f, fx, fy, g, gx, gy
+
     def rd2xy(self, ra, dec):
         if not hasattr(self, 'wcs'):
             print("No wcs loaded!")
@@ -152,74 +331,7 @@ class DSS:
         deltx = 10.0
         delty = 10.0
         while min([abs(deltx), abs(delty)]) > tolerance or iters < maxiters:
-            f = (self.wcs["xcoeff"][0]*obx+                 
-                 self.wcs["xcoeff"][1]*oby+                 
-                 self.wcs["xcoeff"][2]+                     
-                 self.wcs["xcoeff"][3]*obx*obx+             
-                 self.wcs["xcoeff"][4]*obx*oby+             
-                 self.wcs["xcoeff"][5]*oby*oby+             
-                 self.wcs["xcoeff"][6]*(obx*obx+oby*oby)+   
-                 self.wcs["xcoeff"][7]*obx*obx*obx+         
-                 self.wcs["xcoeff"][8]*obx*obx*oby+         
-                 self.wcs["xcoeff"][9]*obx*oby*oby+         
-                 self.wcs["xcoeff"][10]*oby*oby*oby+             
-                 self.wcs["xcoeff"][11]*obx*(obx*obx+oby*oby)+   
-                 self.wcs["xcoeff"][12]*obx*(obx*obx+oby*oby)**2)
-
-            fx = (self.wcs["xcoeff"][0]+                     
-                  self.wcs["xcoeff"][3]*2.0*obx+             
-                  self.wcs["xcoeff"][4]*oby+                 
-                  self.wcs["xcoeff"][6]*2.0*obx+             
-                  self.wcs["xcoeff"][7]*3.0*obx*obx+         
-                  self.wcs["xcoeff"][8]*2.0*obx*oby+         
-                  self.wcs["xcoeff"][9]*oby*oby+             
-                  self.wcs["xcoeff"][11]*(3.0*obx*obx+oby*oby)+   
-                  self.wcs["xcoeff"][12]*(5.0*obx**4 + 6.0*obx**2*oby**2 + oby**4))
-
-            fy = (self.wcs["xcoeff"][1]+                     
-                  self.wcs["xcoeff"][4]*obx+                 
-                  self.wcs["xcoeff"][5]*2.0*oby+             
-                  self.wcs["xcoeff"][6]*2.0*oby+             
-                  self.wcs["xcoeff"][8]*obx*obx+             
-                  self.wcs["xcoeff"][9]*obx*2.0*oby+         
-                  self.wcs["xcoeff"][10]*3.0*oby*oby+        
-                  self.wcs["xcoeff"][11]*2.0*obx*oby+        
-                  self.wcs["xcoeff"][12]*(4.0*obx**3*oby + 4.0*obx*oby**3))
-
-            g = (self.wcs["ycoeff"][0]*oby+                 
-                 self.wcs["ycoeff"][1]*obx+                 
-                 self.wcs["ycoeff"][2]+                     
-                 self.wcs["ycoeff"][3]*oby*oby+             
-                 self.wcs["ycoeff"][4]*oby*obx+             
-                 self.wcs["ycoeff"][5]*obx*obx+             
-                 self.wcs["ycoeff"][6]*(obx*obx+oby*oby)+   
-                 self.wcs["ycoeff"][7]*oby*oby*oby+         
-                 self.wcs["ycoeff"][8]*oby*oby*obx+         
-                 self.wcs["ycoeff"][9]*oby*obx*obx+         
-                 self.wcs["ycoeff"][10]*obx*obx*obx+             
-                 self.wcs["ycoeff"][11]*oby*(obx*obx+oby*oby)+   
-                 self.wcs["ycoeff"][12]*oby*(obx*obx+oby*oby)**2)
-
-            gx = (self.wcs["ycoeff"][1]+                     
-                  self.wcs["ycoeff"][4]*oby+                 
-                  self.wcs["ycoeff"][5]*2.0*obx+             
-                  self.wcs["ycoeff"][6]*2.0*obx+             
-                  self.wcs["ycoeff"][8]*oby*oby+             
-                  self.wcs["ycoeff"][9]*oby*2.0*obx+         
-                  self.wcs["ycoeff"][10]*3.0*obx*obx+        
-                  self.wcs["ycoeff"][11]*2.0*obx*oby+        
-                  self.wcs["ycoeff"][12]*(4.0*obx**3*oby + 4.0*obx*oby**3))
-
-            gy = (self.wcs["ycoeff"][0]+                     
-                  self.wcs["ycoeff"][3]*2.0*oby+             
-                  self.wcs["ycoeff"][4]*obx+                 
-                  self.wcs["ycoeff"][6]*2.0*oby+             
-                  self.wcs["ycoeff"][7]*3.0*oby*oby+         
-                  self.wcs["ycoeff"][8]*2.0*oby*obx+         
-                  self.wcs["ycoeff"][9]*obx*obx+             
-                  self.wcs["ycoeff"][11]*(3.0*oby*oby+obx*obx)+   
-                  self.wcs["ycoeff"][12]*(5.0*oby**4 + 6.0*obx**2*oby**2 + obx**4))
-
+            f, fx, fy, g, gx, gy = self._amd(obx, oby)
             f = f-xi
             g = g-eta
             deltx = (-f*gy+g*fy) / (fx*gy-fy*gx)
@@ -234,9 +346,40 @@ class DSS:
         y = y + 0.5
         return x, y 
 
+    def rd2xyArray(self, ra, dec, maxiters=50, tolerance=0.0000005):
+        """Projects arrays of RA, Dec (degrees) to pixel x, y arrays in a
+        single batched Newton iteration; same model as rd2xy"""
+        import numpy as np
+        ra = np.radians(np.asarray(ra, dtype=float))
+        dec = np.radians(np.asarray(dec, dtype=float))
+        pltra = self.wcs["plate_ra"]
+        pltdec = self.wcs["plate_dec"]
+        cosd = np.cos(dec)
+        sind = np.sin(dec)
+        ra_dif = ra - pltra
+        div = (sind*sin(pltdec) + cosd*cos(pltdec)*np.cos(ra_dif))
+        xi = cosd*np.sin(ra_dif)*self.arcsec_per_radian/div
+        eta = (sind*cos(pltdec) - cosd*sin(pltdec)*np.cos(ra_dif))*self.arcsec_per_radian/div
+        obx = xi/self.wcs["platescl"]
+        oby = eta/self.wcs["platescl"]
+        for iters in range(maxiters):
+            f, fx, fy, g, gx, gy = self._amd(obx, oby)
+            f = f-xi
+            g = g-eta
+            deltx = (-f*gy+g*fy) / (fx*gy-fy*gx)
+            delty = (-g*fx+f*gx) / (fx*gy-fy*gx)
+            obx = obx + deltx
+            oby = oby + delty
+            if obx.size == 0 or max(np.abs(deltx).max(), np.abs(delty).max()) < tolerance:
+                break
+
+        x = (self.wcs["ppo3"] - obx*1000.0)/self.wcs["xpsize"] - self.wcs["xpoff"]
+        y = (self.wcs["ppo6"] + oby*1000.0)/self.wcs["ypsize"] - self.wcs["ypoff"]
+        return x + 0.5, y + 0.5
+
     def skyPA(self):
-        xc = float(self.fitsimg.header["NAXIS1"])/2.0
-        yc = float(self.fitsimg.header["NAXIS2"])/2.0
+        xc = self.wcs["naxis1"]/2.0
+        yc = self.wcs["naxis2"]/2.0
         r1, d1 = self.xy2rd(xc, yc)
         r1 = angles.hrs2rad(angles.sex2deg(r1))
         d1 = angles.deg2rad(angles.sex2deg(d1))
@@ -268,37 +411,19 @@ class DSS:
 
 
     def getDSSImage(self, ra, dec, output, epoch='J2000', width=15.0, height=15.0):
-        ra.replace(':', '%3A')
-        dec.replace(':', '%3A')
-        if output.split('.')[-1] == 'fits':
-            ftype = 'fits'
-        if output.split('.')[-1] == 'gif':
-            ftype = 'gif'
-        pars = (ra, dec, epoch, str(width), str(height), ftype)
-        url = 'https://archive.stsci.edu/cgi-bin/dss_search?v=2r&r=%s&d=%s&e=%s&h=%s&w=%s&f=%s&c=none&fov=NONE&v3=' % pars
-        #mast = 'archive.stsci.edu'
-        #h = http.client.HTTP(mast)
-        #h.putrequest('GET', url)
-        #h.putheader('Accept', 'text/html')
-        #h.putheader('Accept', 'text/plain')
-        #h.endheaders()
-        #reply, msg, hdrs = h.getreply()
-        #doc = h.getfile().read()
-        #doc = requests.get(url).content
-        #$print(doc.content)
-        #if doc[:6] != 'SIMPLE':
-        #    strip_html = re.compile(r'<[^>]*>')
-        #    text = strip_html.sub('', doc)
-        #    print('IOError:')
-        #    raise IOError(text)
-        #else:
+        """Returns the DSS image of the field centered on ra, dec as an
+        open HDUList.  An existing output file is read; otherwise the
+        image comes from self.source (the MAST server unless another
+        imagesource was given) and is stored in output first."""
+        import io
+        import astropy.io.fits as fits
         if os.path.exists(output):
             print("File %s already exists" % output)
-            dat = fits.open(output)
-        else:
-            dat = fits.open(url)
-            dat.writeto(output)
-        return dat
-        #f = open(output, 'w')
-        #f.write(doc)
-        #f.close()
+            return fits.open(output)
+        if self.source is None:
+            import imagesource
+            self.source = imagesource.MASTSource()
+        data = self.source.fetch(ra, dec, epoch, width, height)
+        with fits.open(io.BytesIO(data)) as remote:
+            writeImage(remote, output, compress=self.compress)
+        return fits.open(output)
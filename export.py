@@ -0,0 +1,268 @@
+# Module: export
+# - Writes the results of a run as columnar tables, appending one chunk
+#   per mask as it is processed:
+#       masks       header, guider center and plate solution summary
+#       guidestars  guide stars with xTV/yTV (offsets applied), the
+#                   offsets themselves and their DSS pixel positions
+#       objects     every object of the mask with its DSS pixel position
+# - Parquet when pyarrow is installed, CSV otherwise; NPZ on request
+# - Reads any of the three formats back as a dictionary of NumPy columns
+# Usage:
+#       >>> import export
+#       >>> out = export.Exporter('semester')
+#       >>> out.addMask(m, dss)
+#       >>> out.close()
+#       >>> objects = export.readTable('semester/objects.parquet')
+#       >>> objects['dss_x'][objects['mask'] == 'TestMask0']
+# External modules needed:
+#       numpy, pyarrow (optional)
+#
+# Every row carries the mask name, so a semester of masks is one table
+# per kind, joined on the mask column.
+
+import csv
+import os
+import zipfile
+
+import numpy as np
+
+import angles
+
+tables = ('masks', 'guidestars', 'objects')
+
+# column types of each table, as written by maskColumns; they fix the
+# schema of every chunk, and of a table that receives no rows at all
+schemas = {
+    "masks": [("mask", 'str'), ("file", 'str'), ("ra", 'str'), ("dec", 'str'),
+              ("ra_deg", 'float'), ("dec_deg", 'float'), ("equinox", 'float'),
+              ("pa", 'float'), ("rotdest", 'float'),
+              ("guider_ra", 'str'), ("guider_dec", 'str'),
+              ("guider_ra_deg", 'float'), ("guider_dec_deg", 'float'),
+              ("guider_x", 'float'), ("guider_y", 'float'),
+              ("rotation", 'float'), ("sky_pa", 'float'),
+              ("plate_ra_deg", 'float'), ("plate_dec_deg", 'float'),
+              ("plate_scale", 'float'), ("xpoff", 'float'), ("ypoff", 'float'),
+              ("naxis1", 'int'), ("naxis2", 'int'),
+              ("offset_x", 'int'), ("offset_y", 'int'),
+              ("n_objects", 'int'), ("n_guidestars", 'int')],
+    "guidestars": [("mask", 'str'), ("id", 'str'), ("ra", 'str'), ("dec", 'str'),
+                   ("ra_deg", 'float'), ("dec_deg", 'float'),
+                   ("magnitude", 'float'), ("passband", 'str'),
+                   ("xTV", 'float'), ("yTV", 'float'),
+                   ("offset_x", 'int'), ("offset_y", 'int'),
+                   ("dss_x", 'float'), ("dss_y", 'float')],
+    "objects": [("mask", 'str'), ("id", 'str'), ("kind", 'str'),
+                ("ra_deg", 'float'), ("dec_deg", 'float'),
+                ("magnitude", 'float'), ("passband", 'str'),
+                ("priority_code", 'int'), ("sample", 'int'), ("select_flag", 'int'),
+                ("dss_x", 'float'), ("dss_y", 'float')],
+}
+
+dtypes = {"str": np.str_, "float": np.float64, "int": np.int64}
+
+def haveArrow():
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        return False
+    return True
+
+def chooseFormat(format='auto'):
+    """Returns the table format to use: 'parquet', 'csv' or 'npz'"""
+    if format == 'auto':
+        return 'parquet' if haveArrow() else 'csv'
+    if format not in ('parquet', 'csv', 'npz'):
+        raise ValueError('unknown export format %r' % format)
+    if format == 'parquet' and not haveArrow():
+        raise ValueError('parquet export needs pyarrow')
+    return format
+
+def _deg(ra, dec):
+    return angles.hrs2deg(angles.sex2deg(ra)), angles.sex2deg(dec)
+
+def maskColumns(m, dss):
+    """Returns the columns of the masks, guidestars and objects tables
+    for mask m, whose DSS plate solution is loaded in dss"""
+    import deimos_guider_dss as guider
+    name = m.name.strip()
+    ra, dec = _deg(m.ra, m.dec)
+    gra, gdec = _deg(m.guider_ra, m.guider_dec)
+    wcs = dss.wcs
+    gx, gy = dss.rd2xyArray([gra], [gdec])
+    rotdest = m.pa + 360 if m.pa < 0 else m.pa
+    masks = {
+        "mask": [name], "file": [m.file or ''],
+        "ra": [m.ra], "dec": [m.dec], "ra_deg": [ra], "dec_deg": [dec],
+        "equinox": [float(m.equinox)], "pa": [float(m.pa)],
+        "rotdest": [float(rotdest)],
+        "guider_ra": [m.guider_ra], "guider_dec": [m.guider_dec],
+        "guider_ra_deg": [gra], "guider_dec_deg": [gdec],
+        "guider_x": [float(gx[0])], "guider_y": [float(gy[0])],
+        "rotation": [guider.guiderRotation(m)], "sky_pa": [dss.skyPA()],
+        "plate_ra_deg": [angles.rad2deg(wcs["plate_ra"])],
+        "plate_dec_deg": [angles.rad2deg(wcs["plate_dec"])],
+        "plate_scale": [wcs["platescl"]],
+        "xpoff": [wcs["xpoff"]], "ypoff": [wcs["ypoff"]],
+        "naxis1": [int(wcs["naxis1"])], "naxis2": [int(wcs["naxis2"])],
+        "offset_x": [guider.offset_x], "offset_y": [guider.offset_y],
+        "n_objects": [len(m.objects())], "n_guidestars": [len(m.guideStars)],
+    }
+
+    gs = m.guideStars
+    gsra = [_deg(g.ra, g.dec)[0] for g in gs]
+    gsdec = [_deg(g.ra, g.dec)[1] for g in gs]
+    x, y = dss.rd2xyArray(gsra, gsdec)
+    guidestars = {
+        "mask": [name]*len(gs), "id": [g.id for g in gs],
+        "ra": [g.ra for g in gs], "dec": [g.dec for g in gs],
+        "ra_deg": gsra, "dec_deg": gsdec,
+        "magnitude": [float(g.magnitude) for g in gs],
+        "passband": [str(g.passband) for g in gs],
+        "xTV": [g.xTV for g in gs], "yTV": [g.yTV for g in gs],
+        "offset_x": [guider.offset_x]*len(gs), "offset_y": [guider.offset_y]*len(gs),
+        "dss_x": x, "dss_y": y,
+    }
+
+    objs = ([(o, 'target') for o in m.selectedObjects] +
+            [(o, 'alignment') for o in m.alignmentStars] +
+            [(o, 'guide') for o in m.guideStars])
+    ora = [_deg(o.ra, o.dec)[0] for o, kind in objs]
+    odec = [_deg(o.ra, o.dec)[1] for o, kind in objs]
+    x, y = dss.rd2xyArray(ora, odec)
+    objects = {
+        "mask": [name]*len(objs), "id": [o.id for o, kind in objs],
+        "kind": [kind for o, kind in objs],
+        "ra_deg": ora, "dec_deg": odec,
+        "magnitude": [float(o.magnitude) for o, kind in objs],
+        "passband": [str(o.passband) for o, kind in objs],
+        "priority_code": [int(o.priority_code) for o, kind in objs],
+        "sample": [int(o.sample) for o, kind in objs],
+        "select_flag": [int(o.select_flag) for o, kind in objs],
+        "dss_x": x, "dss_y": y,
+    }
+    return {"masks": masks, "guidestars": guidestars, "objects": objects}
+
+class ParquetTable:
+    """Appends chunks to a Parquet file, one row group each"""
+    def __init__(self, path, schema):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        types = {"str": pa.string(), "float": pa.float64(), "int": pa.int64()}
+        self.schema = pa.schema([(n, types[k]) for n, k in schema])
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.path = path
+
+    def write(self, columns):
+        import pyarrow as pa
+        self.writer.write_table(pa.table(columns, schema=self.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+class CSVTable:
+    """Appends chunks to a CSV file with a header line"""
+    def __init__(self, path, schema):
+        self.path = path
+        self.f = open(path, 'w', newline='')
+        self.writer = csv.writer(self.f)
+        self.names = [n for n, k in schema]
+        self.writer.writerow(self.names)
+
+    def write(self, columns):
+        self.writer.writerows(zip(*[columns[n] for n in self.names]))
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+class NPZTable:
+    """Appends chunks to a NumPy .npz archive; column c of chunk n is
+    stored as c/n and readTable joins the chunks"""
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = schema
+        self.zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        self.chunks = 0
+
+    def write(self, columns):
+        for name, kind in self.schema:
+            with self.zip.open('%s/%06d.npy' % (name, self.chunks), 'w') as f:
+                np.lib.format.write_array(f, np.asarray(columns[name], dtype=dtypes[kind]),
+                                          allow_pickle=False)
+        self.chunks += 1
+
+    def close(self):
+        if self.zip is None:
+            return
+        if self.chunks == 0:
+            # an empty chunk keeps the columns and their types
+            self.write(dict((n, []) for n, k in self.schema))
+        self.zip.close()
+        self.zip = None
+
+writers = {"parquet": ParquetTable, "csv": CSVTable, "npz": NPZTable}
+
+class Exporter:
+    """Writes the masks, guidestars and objects tables of a run into
+    directory outdir, one chunk per mask"""
+    def __init__(self, outdir, format='auto'):
+        self.format = chooseFormat(format)
+        self.outdir = outdir
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        self.tables = dict((t, writers[self.format](self.path(t), schemas[t]))
+                           for t in tables)
+
+    def path(self, table):
+        return os.path.join(self.outdir, '%s.%s' % (table, self.format))
+
+    def addMask(self, m, dss):
+        for name, columns in maskColumns(m, dss).items():
+            if len(columns["mask"]):
+                self.tables[name].write(columns)
+
+    def close(self):
+        for t in self.tables.values():
+            t.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def readTable(path):
+    """Reads a table written by Exporter (any format) into a dictionary
+    of NumPy arrays, one per column"""
+    ext = os.path.splitext(path)[1]
+    if ext == '.parquet':
+        import pyarrow.parquet as pq
+        t = pq.read_table(path)
+        return dict((n, t.column(n).to_numpy()) for n in t.column_names)
+    if ext == '.npz':
+        chunks = {}
+        with np.load(path, allow_pickle=False) as z:
+            for key in z.files:
+                name = key.rsplit('/', 1)[0]
+                chunks.setdefault(name, []).append(z[key])
+        return dict((n, np.concatenate(c)) for n, c in chunks.items())
+    with open(path, newline='') as f:
+        rows = list(csv.reader(f))
+    # CSV keeps no types: take them from the table's schema
+    table = os.path.splitext(os.path.basename(path))[0]
+    kinds = dict(schemas.get(table, []))
+    out = {}
+    for i, name in enumerate(rows[0] if rows else []):
+        values = [r[i] for r in rows[1:]]
+        kind = kinds.get(name, 'str')
+        if kind == 'str':
+            out[name] = np.array(values, dtype=np.str_)
+        elif kind == 'int' and '' not in values:
+            out[name] = np.array([int(v) for v in values], dtype=np.int64)
+        else:
+            # an empty cell is a missing value
+            out[name] = np.array([float(v) if v != '' else np.nan for v in values],
+                                 dtype=np.float64)
+    return out
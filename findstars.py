@@ -0,0 +1,183 @@
+# Module: findstars
+# - Finds point sources in a decoded DSS frame (background estimation,
+#   thresholding and centroiding, all in NumPy)
+# - Ranks the detections inside the guider box as guide star candidates
+# Usage:
+#       >>> import findstars
+#       >>> sources = findstars.findSources(fitsimg[0].data)
+#       >>> cands = findstars.rankCandidates(sources, dss, (450, 450), rot)
+#       >>> for c in cands:
+#       ...     print(c.rank, c.ra, c.dec, c.flux, c.isolation)
+# External modules needed:
+#       numpy
+#
+# Pixel positions use the same 1-based convention as DSS.rd2xy, so a
+# source can be drawn with exactly the same code as a mask guide star.
+
+import copy
+import math
+import numpy as np
+
+class Source:
+    def __init__(self, x, y, flux, peak, isolation, saturated):
+        self.x = x
+        self.y = y
+        self.flux = flux
+        self.peak = peak
+        self.isolation = isolation
+        self.saturated = saturated
+        self.ra = None
+        self.dec = None
+        self.rank = None
+
+def estimateBackground(a, box=64, nsigma=3.0, iters=3):
+    """Returns (background map, noise sigma) of a 2-D image.
+
+    The background is the median in box x box cells, expanded back to
+    the image size; the noise comes from sigma-clipped, MAD-based
+    statistics of a subsample of the frame.
+    """
+    a = np.asarray(a, dtype=np.float32)
+    ny, nx = a.shape
+    sample = a[::2, ::2].ravel()
+    for i in range(iters):
+        med = np.median(sample)
+        std = 1.4826*np.median(np.abs(sample - med))
+        keep = np.abs(sample - med) < nsigma*std
+        if keep.all() or std == 0:
+            break
+        sample = sample[keep]
+    sigma = max(float(std), 1e-6)
+
+    # median per cell, padding the last row/column of cells with NaN
+    my = -(-ny//box)
+    mx = -(-nx//box)
+    padded = np.full((my*box, mx*box), np.nan, dtype=np.float32)
+    padded[:ny, :nx] = np.where(np.abs(a - med) < nsigma*sigma, a, np.nan)
+    cells = padded.reshape(my, box, mx, box).swapaxes(1, 2).reshape(my, mx, -1)
+    with np.errstate(all='ignore'):
+        mesh = np.nanmedian(cells, axis=2)
+    mesh = np.where(np.isfinite(mesh), mesh, med)
+    bkg = np.repeat(np.repeat(mesh, box, axis=0), box, axis=1)[:ny, :nx]
+    return bkg, sigma
+
+def _shifts(a, r):
+    """Yields copies of a shifted by every offset within r (edges padded)."""
+    ny, nx = a.shape
+    p = np.pad(a, r, mode='edge')
+    for dy in range(-r, r+1):
+        for dx in range(-r, r+1):
+            yield dy, dx, p[r+dy:r+dy+ny, r+dx:r+dx+nx]
+
+def findSources(a, nsigma=5.0, box=64, cbox=2, abox=3, edge=5,
+                saturation=None, maxsources=2000, minsep=6.0, origin=(0, 0)):
+    """Detects point sources in a 2-D image.
+
+    Local maxima of a 3x3 smoothed, background-subtracted frame that lie
+    nsigma above the noise are centroided with first moments in a
+    (2*cbox+1)^2 window; flux is summed in a (2*abox+1)^2 window.
+    Isolation is the distance (pixels) to the nearest detection at least
+    a tenth as bright.  When a is a section of a larger frame, origin is
+    the 0-based (x, y) of its first pixel and positions are returned in
+    the full frame.  Returns a list of Source sorted by flux.
+    """
+    a = np.asarray(a, dtype=np.float32)
+    ny, nx = a.shape
+    bkg, sigma = estimateBackground(a, box=box)
+    d = a - bkg
+    if saturation is None:
+        saturation = 0.98*float(a.max())
+
+    smooth = np.zeros_like(d)
+    for dy, dx, s in _shifts(d, 1):
+        smooth += s
+    smooth /= 9.0
+    peaks = smooth > nsigma*sigma/3.0
+    for dy, dx, s in _shifts(smooth, 1):
+        if dy or dx:
+            peaks &= smooth >= s
+    peaks[:edge, :] = False
+    peaks[-edge:, :] = False
+    peaks[:, :edge] = False
+    peaks[:, -edge:] = False
+    py, px = np.nonzero(peaks)
+    if len(py) == 0:
+        return []
+    if len(py) > maxsources:
+        keep = np.argsort(smooth[py, px])[::-1][:maxsources]
+        py = py[keep]
+        px = px[keep]
+
+    # first moments and aperture sums, vectorized over all peaks
+    pad = max(cbox, abox)
+    dp = np.pad(d, pad, mode='constant')
+    ap = np.pad(a, pad, mode='constant')
+    off = np.arange(-pad, pad+1)
+    oy, ox = np.meshgrid(off, off, indexing='ij')
+    stamps = dp[py[:, None, None] + pad + oy, px[:, None, None] + pad + ox]
+    raw = ap[py[:, None, None] + pad + oy, px[:, None, None] + pad + ox]
+    inner = (np.abs(oy) <= cbox) & (np.abs(ox) <= cbox)
+    outer = (np.abs(oy) <= abox) & (np.abs(ox) <= abox)
+    w = np.clip(stamps, 0, None)*inner
+    wsum = w.sum(axis=(1, 2))
+    wsum[wsum == 0] = 1.0
+    cy = py + (w*oy).sum(axis=(1, 2))/wsum
+    cx = px + (w*ox).sum(axis=(1, 2))/wsum
+    flux = (stamps*outer).sum(axis=(1, 2))
+    peak = (raw*inner).max(axis=(1, 2))
+    # a saturated star has a flat top: more pixels at the plate limit
+    # than the 2x2 block an unsaturated star centered on a corner gives
+    flat = ((raw >= saturation) & inner).sum(axis=(1, 2))
+
+    # merge peaks closer than minsep (double maxima on one star)
+    order = np.argsort(flux)[::-1]
+    cx, cy, flux, peak, flat = cx[order], cy[order], flux[order], peak[order], flat[order]
+    dx = cx[:, None] - cx[None, :]
+    dy = cy[:, None] - cy[None, :]
+    dist = np.hypot(dx, dy)
+    np.fill_diagonal(dist, np.inf)
+    brighter = np.tri(len(cx), k=-1, dtype=bool)
+    dup = ((dist < minsep) & brighter).any(axis=1)
+    keep = ~dup & (flux > 0)
+    cx, cy, flux, peak, flat = cx[keep], cy[keep], flux[keep], peak[keep], flat[keep]
+    dist = dist[np.ix_(keep, keep)]
+
+    rivals = flux[None, :] >= 0.1*flux[:, None]
+    isolation = np.where(rivals, dist, np.inf).min(axis=1) if len(cx) > 1 \
+        else np.full(len(cx), np.inf)
+
+    return [Source(float(x) + 1.0 + origin[0], float(y) + 1.0 + origin[1],
+                   float(f), float(p),
+                   float(iso), bool(n >= 5))
+            for x, y, f, p, iso, n in zip(cx, cy, flux, peak, isolation, flat)]
+
+def rankCandidates(sources, dss, center, angle, box=212, nmax=5,
+                   minisolation=10.0):
+    """Returns the best guide star candidates inside the guider box.
+
+    center is the guider box center in DSS pixels, angle the image
+    rotation (degrees) used to draw the box, and box its size in
+    pixels.  Unsaturated sources isolated by at least minisolation
+    pixels are ranked by flux, followed by the crowded ones.  Sky
+    coordinates come from the DSS plate solution.  The candidates are
+    copies, so one list of sources can be ranked for several masks.
+    """
+    radrot = math.radians(angle)
+    cosr = math.cos(radrot)
+    sinr = math.sin(radrot)
+    inside = []
+    for s in sources:
+        if s.saturated:
+            continue
+        dx = s.x - center[0]
+        dy = s.y - center[1]
+        rx = dx*cosr - dy*sinr
+        ry = dx*sinr + dy*cosr
+        if abs(rx) <= box/2.0 and abs(ry) <= box/2.0:
+            inside.append(s)
+    inside.sort(key=lambda s: (s.isolation < minisolation, -s.flux))
+    cands = [copy.copy(s) for s in inside[:nmax]]
+    for i, s in enumerate(cands):
+        s.rank = i + 1
+        s.ra, s.dec = dss.xy2rd(s.x, s.y)
+    return cands
@@ -1,9 +1,7 @@
 #!/usr/bin/env python
 
 import numpy as np
-from astropy.io import fits
 from PIL import Image
-from PIL import ImageChops
 import sys
 
 def zScale(a):
@@ -12,19 +10,24 @@ def zScale(a):
     std = np.sqrt(var)
     return mean - 3*std, mean + 7*std
     
-def arrayToGreyImage(a):
+def arrayToGreyArray(a):
+    """Returns the 8-bit display version of a (scaled, flipped top to
+    bottom and inverted) as a uint8 array"""
     z1, z2 = zScale(a)
     bzero = z1
     bscale = (z2 - z1)/256.0
     a = np.divide(np.subtract(a, bzero), bscale)
     a = np.clip(a, 0, 255.0)
-    a = a.astype('b')    # needed so a.tostring() method returns single bytes
+    a = a.astype(np.uint8)
     a = a[::-1]
-    i = Image.frombytes('L', (a.shape[1], a.shape[0]), a.tostring())
-    return ImageChops.invert(i)
+    return np.ascontiguousarray(255 - a)
+
+def arrayToGreyImage(a):
+    return Image.fromarray(arrayToGreyArray(a))
 
 
 if __name__ == '__main__':
+    from astropy.io import fits
     infile = sys.argv[1]
     output = sys.argv[2]
     f = fits.open(infile, 'r')
@@ -0,0 +1,201 @@
+# Module: guidersim
+# - Simulates the DEIMOS guider camera frame of a mask: the DSS region
+#   is resampled into guider detector pixels (guider_scale arcsec/pix
+#   over guider_ccd arcsec) through the DSS plate solution and the TV
+#   offsets, blurred by a seeing PSF and given sky, shot and read noise
+# - Maps guider TV pixels to DSS pixels and back
+# - Draws the simulated frame with the guide stars at their xTV/yTV
+# Usage:
+#       >>> import guidersim
+#       >>> frame, geom = guidersim.simulateGuider(m, dss, data, origin)
+#       >>> x, y = geom.toTV(*dss.rd2xyArray(ra, dec))
+#       >>> guidersim.tvImage(frame, m, geom).save('mask1_guider_tv.png')
+# External modules needed:
+#       numpy, PIL
+#
+# TV pixels are 1-based like xTV/yTV.  The center of the field falls on
+# the detector center shifted by the TV offsets, and the frame has the
+# orientation of the guider view (x to the right, y down).  The PSF is
+# convolved with FFTs; the transform of the PSF is cached, so masks with
+# the same frame size and seeing only pay for the image transforms.
+
+import functools
+import math
+import zlib
+
+import numpy as np
+
+class TVGeometry:
+    """Affine map between guider TV pixels and DSS pixels.
+
+    center_dss is the DSS pixel of the guider center, center_tv its TV
+    pixel, scale the DSS pixels per TV pixel and angle (degrees) the
+    rotation of the guider view."""
+    def __init__(self, center_dss, center_tv, scale, angle, shape):
+        self.center_dss = center_dss
+        self.center_tv = center_tv
+        self.scale = scale
+        self.angle = angle
+        self.shape = shape
+        t = math.radians(angle)
+        # the view is the DSS frame flipped top to bottom and rotated, so
+        # this matrix is a reflection: it is its own inverse up to scale
+        self.matrix = np.array([[math.cos(t), -math.sin(t)],
+                                [-math.sin(t), -math.cos(t)]])*scale
+
+    def toDSS(self, x, y):
+        """Returns the DSS pixels of TV pixels x, y"""
+        dx = np.asarray(x, dtype=float) - self.center_tv[0]
+        dy = np.asarray(y, dtype=float) - self.center_tv[1]
+        m = self.matrix
+        return (self.center_dss[0] + m[0, 0]*dx + m[0, 1]*dy,
+                self.center_dss[1] + m[1, 0]*dx + m[1, 1]*dy)
+
+    def toTV(self, x, y):
+        """Returns the TV pixels of DSS pixels x, y"""
+        dx = np.asarray(x, dtype=float) - self.center_dss[0]
+        dy = np.asarray(y, dtype=float) - self.center_dss[1]
+        m = self.matrix/self.scale**2
+        return (self.center_tv[0] + m[0, 0]*dx + m[0, 1]*dy,
+                self.center_tv[1] + m[1, 0]*dx + m[1, 1]*dy)
+
+def tvGeometry(m, dss, scale=None, ccd=None, offsets=None):
+    """Returns the TVGeometry of mask m on the DSS frame whose plate
+    solution is loaded in dss.  scale (arcsec/pix), ccd (arcsec) and
+    offsets (TV pixels) default to the guider constants."""
+    import angles
+    import deimos_guider_dss as guider
+    if scale is None:
+        scale = guider.guider_scale
+    if ccd is None:
+        ccd = guider.guider_ccd
+    if offsets is None:
+        offsets = (guider.offset_x, guider.offset_y)
+    nx = int(round(ccd[0]/scale))
+    ny = int(round(ccd[1]/scale))
+    gx, gy = dss.rd2xyArray([angles.hrs2deg(angles.sex2deg(m.guider_ra))],
+                            [angles.sex2deg(m.guider_dec)])
+    # arcsec per DSS pixel
+    dss_scale = dss.wcs["platescl"]*dss.wcs["xpsize"]/1000.0
+    center_tv = ((nx + 1)/2.0 + offsets[0], (ny + 1)/2.0 + offsets[1])
+    return TVGeometry((float(gx[0]), float(gy[0])), center_tv,
+                      scale/dss_scale, guider.guiderRotation(m), (ny, nx))
+
+def resample(data, origin, geom, pad=0, fill=0.0):
+    """Resamples the DSS section data (first pixel at 0-based origin)
+    onto the TV pixel grid of geom, grown by pad pixels on every side;
+    pixels outside data are set to fill"""
+    import PIL.Image as Image
+    ny, nx = geom.shape
+    m = geom.matrix
+    # PIL maps output to input in continuous coordinates, where pixel
+    # centers are at +0.5: TV x = xo + 0.5 - pad, DSS x = xi + 0.5 + origin
+    tx = 0.5 - pad - geom.center_tv[0]
+    ty = 0.5 - pad - geom.center_tv[1]
+    c = geom.center_dss[0] - 0.5 - origin[0] + m[0, 0]*tx + m[0, 1]*ty
+    f = geom.center_dss[1] - 0.5 - origin[1] + m[1, 0]*tx + m[1, 1]*ty
+    im = Image.fromarray(np.ascontiguousarray(data, dtype=np.float32))
+    out = im.transform((nx + 2*pad, ny + 2*pad), Image.AFFINE,
+                       (m[0, 0], m[0, 1], c, m[1, 0], m[1, 1], f),
+                       Image.BICUBIC, fillcolor=fill)
+    return np.array(out, dtype=np.float32)
+
+@functools.lru_cache(maxsize=8)
+def psfTransform(shape, fwhm, beta=3.0):
+    """Returns the real FFT of a unit Moffat PSF of fwhm pixels, centered
+    on pixel (0, 0) of a frame of shape"""
+    ny, nx = shape
+    alpha = fwhm/(2.0*math.sqrt(2.0**(1.0/beta) - 1.0))
+    y = np.fft.fftfreq(ny)*ny
+    x = np.fft.fftfreq(nx)*nx
+    r2 = y[:, None]**2 + x[None, :]**2
+    psf = (1.0 + r2/alpha**2)**(-beta)
+    psf /= psf.sum()
+    return np.fft.rfft2(psf)
+
+def convolve(a, fwhm, beta=3.0):
+    """Convolves a with a Moffat PSF of fwhm pixels (periodic edges)"""
+    if fwhm <= 0:
+        return a
+    otf = psfTransform(a.shape, float(fwhm), float(beta))
+    return np.fft.irfft2(np.fft.rfft2(a)*otf, s=a.shape).astype(np.float32)
+
+def addNoise(e, gain=2.0, readnoise=10.0, rng=None):
+    """Returns ADU for a frame of expected electrons e, with shot noise
+    and Gaussian read noise"""
+    if rng is None:
+        rng = np.random.default_rng()
+    counts = rng.poisson(np.clip(e, 0, None)).astype(np.float32)
+    counts += rng.normal(0.0, readnoise, e.shape).astype(np.float32)
+    return counts/gain
+
+def simulateGuider(m, dss, data, origin=(0, 0), seeing=0.7, beta=3.0,
+                   signal=100.0, sky=200.0, gain=2.0, readnoise=10.0,
+                   grain=5.0, seed=None, geom=None):
+    """Returns (frame, geom): the simulated guider frame of mask m in ADU
+    (rows are TV y, columns TV x) and its TVGeometry.
+
+    data is the DSS frame, or its section starting at 0-based pixel
+    origin.  seeing is the PSF FWHM (arcsec); signal the electrons per
+    DSS count above the background in one DSS pixel; sky the sky
+    electrons per TV pixel.  DSS pixels further than one pixel from a
+    grain sigma detection (as in findstars) are plate noise and are
+    dropped.  The noise is seeded
+    from the mask name unless seed is given, so a mask always gives the
+    same frame."""
+    import deimos_guider_dss as guider
+    import findstars
+    if geom is None:
+        geom = tvGeometry(m, dss)
+    fwhm = seeing/guider.guider_scale
+    bkg, sigma = findstars.estimateBackground(data)
+    d = np.asarray(data, dtype=np.float32) - bkg
+    # keep the pixels within one pixel of a significant 3x3 mean
+    smooth = np.zeros_like(d)
+    for dy, dx, s in findstars._shifts(d, 1):
+        smooth += s
+    keep = smooth/9.0 > grain*sigma/3.0
+    grown = np.zeros_like(keep)
+    for dy, dx, s in findstars._shifts(keep, 1):
+        grown |= s
+    d[~grown] = 0.0
+    # room for the PSF wings, rounded up to a size FFTs handle well
+    pad = 16*int(math.ceil(2.0*fwhm/16.0))
+    img = resample(d, origin, geom, pad)
+    # the DSS counts of one DSS pixel are spread over scale**-2 TV pixels
+    e = img*(signal*geom.scale**2)
+    e = convolve(e, fwhm, beta)[pad:pad+geom.shape[0], pad:pad+geom.shape[1]]
+    e += sky
+    if seed is None:
+        seed = zlib.crc32(m.name.strip().encode('utf-8'))
+    frame = addNoise(e, gain, readnoise, np.random.default_rng(seed))
+    return frame, geom
+
+def tvImage(frame, m, geom=None, dss=None, font=None):
+    """Returns an RGB display of the simulated frame with each guide star
+    circled at its xTV/yTV and, when dss is given, a cross at the
+    position the plate solution predicts"""
+    import PIL.Image as Image, PIL.ImageDraw as ImageDraw
+    import angles
+    import fits2pil
+    import deimos_guider_dss as guider
+    if font is None:
+        font = guider.loadFont()
+    z1, z2 = fits2pil.zScale(frame[::4, ::4])
+    grey = np.clip((frame - z1)*(255.0/max(z2 - z1, 1e-6)), 0, 255).astype(np.uint8)
+    im = Image.fromarray(grey).convert('RGB')
+    draw = ImageDraw.Draw(im)
+    for gs in m.guideStars:
+        x = gs.xTV - 1
+        y = gs.yTV - 1
+        draw.ellipse((x-20, y-20, x+20, y+20), outline=guider.colors['red'])
+        draw.text((x+24, y-24), gs.id.upper(), font=font, fill=guider.colors['red'])
+        if dss is not None and geom is not None:
+            px, py = dss.rd2xyArray([angles.hrs2deg(angles.sex2deg(gs.ra))],
+                                    [angles.sex2deg(gs.dec)])
+            tx, ty = geom.toTV(px, py)
+            tx = float(tx[0]) - 1
+            ty = float(ty[0]) - 1
+            draw.line((tx-8, ty, tx+8, ty), fill=guider.colors['yellow'])
+            draw.line((tx, ty-8, tx, ty+8), fill=guider.colors['yellow'])
+    return im
@@ -0,0 +1,206 @@
+# Module: imagesource
+# - Sources of DSS images for dss.DSS.getDSSImage: every source returns
+#   the bytes of a FITS image for a field center and size
+#       MASTSource        the MAST DSS server (archive.stsci.edu)
+#       DirectorySource   images already on disk, one file per field
+#       RecordingSource   fetches from another source and keeps a copy
+#       ReplaySource      serves recorded images with configurable
+#                         latency and injected failures, for offline
+#                         runs, CI and throughput benchmarks
+#       FallbackSource    tries several sources in turn
+# - Builds a source from a short command line specification
+# Usage:
+#       >>> import imagesource
+#       >>> src = imagesource.fromSpec('replay:tests/dss:latency=0.5:fail=0.1')
+#       >>> d = dss.DSS(source=src)
+#       >>> d.getDSSImage('10:56:59.9', '-03:37:37.9', 'ms1054_dss.fits')
+# External modules needed:
+#       None
+#
+# Sources raise IOError when an image cannot be had, like the MAST
+# server path always did.  Recorded and local images are stored as
+# <directory>/<imageName(...)>, so a recording is also a DirectorySource.
+
+import os
+import random
+import re
+import threading
+import time
+
+mast_url = ('https://archive.stsci.edu/cgi-bin/dss_search?v=2r&r=%s&d=%s&e=%s'
+            '&h=%s&w=%s&f=%s&c=none&fov=NONE&v3=')
+
+def imageName(ra, dec, epoch='J2000', width=15.0, height=15.0):
+    """Returns the file name under which a field is stored"""
+    key = '%s_%s_%s_%gx%g' % (ra, dec, epoch, width, height)
+    return 'dss_%s.fits' % re.sub(r'[^0-9A-Za-z.+-]', '_', key)
+
+def checkFITS(data, origin):
+    """Raises IOError unless data is a FITS file; the server reports
+    errors as an HTML page, whose text is included"""
+    if data[:6] == b'SIMPLE':
+        return data
+    text = re.sub(r'<[^>]*>', '', data[:2000].decode('latin-1'))
+    text = ' '.join(text.split())
+    raise IOError('%s did not return a FITS image: %s' % (origin, text))
+
+class ImageSource:
+    """Base class: fetch() returns the bytes of a FITS image of the field
+    centered on ra, dec (sexagesimal) of width x height arcmin"""
+    name = 'source'
+
+    def fetch(self, ra, dec, epoch='J2000', width=15.0, height=15.0):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return '<%s>' % self.name
+
+class MASTSource(ImageSource):
+    name = 'mast'
+
+    def __init__(self, url=mast_url, timeout=60.0):
+        self.url = url
+        self.timeout = timeout
+
+    def fetch(self, ra, dec, epoch='J2000', width=15.0, height=15.0):
+        import urllib.request
+        url = self.url % (ra, dec, epoch, str(width), str(height), 'fits')
+        try:
+            with urllib.request.urlopen(url, timeout=self.timeout) as reply:
+                data = reply.read()
+        except OSError as err:
+            raise IOError('MAST DSS request failed: %s' % err)
+        return checkFITS(data, 'MAST')
+
+class DirectorySource(ImageSource):
+    """Images stored in directory, named by imageName()"""
+    def __init__(self, directory):
+        self.directory = directory
+        self.name = 'dir:%s' % directory
+
+    def path(self, ra, dec, epoch='J2000', width=15.0, height=15.0):
+        return os.path.join(self.directory, imageName(ra, dec, epoch, width, height))
+
+    def fetch(self, ra, dec, epoch='J2000', width=15.0, height=15.0):
+        path = self.path(ra, dec, epoch, width, height)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError as err:
+            raise IOError('no DSS image for %s %s in %s: %s' % (ra, dec, self.directory, err))
+        return checkFITS(data, path)
+
+class RecordingSource(DirectorySource):
+    """Fetches from upstream and stores each image in directory; fields
+    already recorded are served from disk"""
+    def __init__(self, directory, upstream=None):
+        DirectorySource.__init__(self, directory)
+        self.upstream = upstream or MASTSource()
+        self.name = 'record:%s' % directory
+
+    def fetch(self, ra, dec, epoch='J2000', width=15.0, height=15.0):
+        path = self.path(ra, dec, epoch, width, height)
+        if os.path.exists(path):
+            return DirectorySource.fetch(self, ra, dec, epoch, width, height)
+        data = self.upstream.fetch(ra, dec, epoch, width, height)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # write then rename, so an interrupted run leaves no partial image
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return data
+
+class ReplaySource(DirectorySource):
+    """Serves recorded images, waiting latency seconds (plus up to jitter
+    more) per request and failing a fraction fail of them with IOError.
+    Failures are drawn from a generator seeded with seed, so a run can
+    be repeated exactly."""
+    def __init__(self, directory, latency=0.0, jitter=0.0, fail=0.0, seed=0):
+        DirectorySource.__init__(self, directory)
+        self.latency = latency
+        self.jitter = jitter
+        self.fail = fail
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.name = 'replay:%s' % directory
+
+    def fetch(self, ra, dec, epoch='J2000', width=15.0, height=15.0):
+        with self.lock:
+            delay = self.latency + self.jitter*self.rng.random()
+            failed = self.rng.random() < self.fail
+        if delay > 0:
+            time.sleep(delay)
+        if failed:
+            raise IOError('injected failure for %s %s' % (ra, dec))
+        return DirectorySource.fetch(self, ra, dec, epoch, width, height)
+
+class FallbackSource(ImageSource):
+    """Tries each source in turn and returns the first image found"""
+    def __init__(self, sources):
+        self.sources = sources
+        self.name = ','.join(s.name for s in sources)
+
+    def fetch(self, ra, dec, epoch='J2000', width=15.0, height=15.0):
+        errors = []
+        for s in self.sources:
+            try:
+                return s.fetch(ra, dec, epoch, width, height)
+            except IOError as err:
+                errors.append('%s: %s' % (s.name, err))
+        raise IOError('; '.join(errors))
+
+def _options(fields, allowed):
+    opts = {}
+    for f in fields:
+        key, sep, value = f.partition('=')
+        if not sep or key not in allowed:
+            raise ValueError('unknown image source option %r' % f)
+        opts[key] = float(value) if key != 'seed' else int(value)
+    return opts
+
+def _directory(rest, allowed):
+    """Splits 'DIRECTORY[:key=value]..' into the directory and its
+    options.  Only trailing key=value fields with a known key are
+    options, so the directory itself may contain colons."""
+    fields = rest.split(':')
+    n = len(fields)
+    while n > 1 and fields[n-1].partition('=')[0] in allowed:
+        n -= 1
+    return ':'.join(fields[:n]), _options(fields[n:], allowed)
+
+def fromSpec(spec):
+    """Builds a source from spec: a comma separated list of sources
+    tried in turn, each one of
+
+        mast[:timeout=S]
+        dir:DIRECTORY
+        record:DIRECTORY[:timeout=S]
+        replay:DIRECTORY[:latency=S][:jitter=S][:fail=F][:seed=N]
+
+    DIRECTORY may contain colons.
+    """
+    sources = []
+    for item in spec.split(','):
+        kind, sep, rest = item.partition(':')
+        if kind == 'mast':
+            sources.append(MASTSource(**_options(rest.split(':') if sep else [],
+                                                 ('timeout',))))
+        elif kind == 'dir' and rest:
+            sources.append(DirectorySource(rest))
+        elif kind == 'record' and rest:
+            directory, opts = _directory(rest, ('timeout',))
+            if not directory:
+                raise ValueError('bad image source %r' % item)
+            sources.append(RecordingSource(directory, MASTSource(**opts)))
+        elif kind == 'replay' and rest:
+            directory, opts = _directory(rest, ('latency', 'jitter', 'fail', 'seed'))
+            if not directory:
+                raise ValueError('bad image source %r' % item)
+            sources.append(ReplaySource(directory, **opts))
+        else:
+            raise ValueError('bad image source %r' % item)
+    if len(sources) == 1:
+        return sources[0]
+    return FallbackSource(sources)
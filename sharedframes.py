@@ -0,0 +1,119 @@
+# Module: sharedframes
+# - Publishes decoded DSS frames (raw pixels and the 8-bit display
+#   version) once in shared memory, keyed by plate
+# - Worker processes attach to a published frame zero-copy through a
+#   small picklable descriptor
+# - Frames are reference counted: the shared memory is unlinked when the
+#   last mask rendered from it has been released
+# Usage:
+#       >>> frames = sharedframes.SharedFrames(maxframes=4)
+#       >>> desc = frames.publish(key, {'data': data, 'grey': grey}, refs=3)
+#       >>> # in a worker process
+#       >>> with sharedframes.attach(desc) as a:
+#       ...     render(a['data'], a['grey'])
+#       >>> # in the parent, once per mask rendered from the frame
+#       >>> frames.release(key)
+# External modules needed:
+#       numpy
+#
+# Memory for a run is bounded by maxframes frames, however many worker
+# processes attach to them.
+
+import contextlib
+import sys
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+
+def _open(name):
+    # the publisher owns the block; attaching must not make the worker's
+    # resource tracker unlink it when the worker exits
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    return shared_memory.SharedMemory(name=name)
+
+class SharedFrames:
+    """Frames published in shared memory by the parent process"""
+    def __init__(self, maxframes=None):
+        self.lock = threading.Lock()
+        self.frames = {}
+        self.slots = threading.BoundedSemaphore(maxframes) if maxframes else None
+
+    def publish(self, key, arrays, refs=1):
+        """Copies the dictionary of arrays into shared memory under key
+        and returns its descriptor.  The frame lives until release(key)
+        has been called refs times.  When maxframes frames are already
+        published, blocks until one of them is released."""
+        if self.slots is not None:
+            self.slots.acquire()
+        blocks = []
+        desc = {}
+        try:
+            for name, a in arrays.items():
+                a = np.ascontiguousarray(a)
+                shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+                blocks.append(shm)
+                np.ndarray(a.shape, a.dtype, buffer=shm.buf)[...] = a
+                desc[name] = (shm.name, a.shape, a.dtype.str)
+        except BaseException:
+            self._free(blocks)
+            raise
+        with self.lock:
+            if key in self.frames:
+                self._free(blocks)
+                raise KeyError('frame %r is already published' % (key,))
+            self.frames[key] = [blocks, refs, desc]
+        return desc
+
+    def release(self, key):
+        """Drops one reference to the frame published under key"""
+        with self.lock:
+            frame = self.frames[key]
+            frame[1] -= 1
+            if frame[1] > 0:
+                return
+            del self.frames[key]
+        self._free(frame[0])
+
+    def _free(self, blocks):
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+        if self.slots is not None:
+            self.slots.release()
+
+    def nbytes(self):
+        """Returns the shared memory currently held, in bytes"""
+        with self.lock:
+            return sum(shm.size for f in self.frames.values() for shm in f[0])
+
+    def close(self):
+        """Frees every frame, whatever its reference count"""
+        with self.lock:
+            frames = list(self.frames.values())
+            self.frames.clear()
+        for f in frames:
+            self._free(f[0])
+
+@contextlib.contextmanager
+def attach(desc):
+    """Attaches to a published frame and yields a dictionary of read-only
+    arrays viewing the shared memory.  The arrays, and anything built on
+    their buffers, must not be used after the block exits."""
+    blocks = []
+    arrays = {}
+    a = None
+    try:
+        for name, (shmname, shape, dtype) in desc.items():
+            shm = _open(shmname)
+            blocks.append(shm)
+            a = np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+            a.flags.writeable = False
+            arrays[name] = a
+        yield arrays
+    finally:
+        arrays.clear()
+        a = None
+        for shm in blocks:
+            shm.close()
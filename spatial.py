@@ -0,0 +1,136 @@
+# Module: spatial
+# - KD-tree over unit vectors on the celestial sphere
+# - Cone and box (tangent plane) queries, and cross-matching of two indexes
+# Usage:
+#       >>> import spatial
+#       >>> idx = spatial.SkyIndex(ra_deg, dec_deg)
+#       >>> idx.cone(164.25, -3.62, 30.0)          # radius in arcsec
+#       >>> idx.box(164.25, -3.62, 212.0, 212.0, pa=30.0)
+#       >>> idx.crossMatch(other_idx, 1.0)          # [(i, j, sep), ...]
+# External modules needed:
+#       numpy
+#
+# Queries are batched: every query point walks the tree together, so
+# matching thousands of objects costs a few NumPy calls per tree node
+# rather than a Python loop per object.
+
+import math
+import numpy as np
+
+ARCSEC = math.pi/(180.0*3600.0)
+
+def radec2xyz(ra, dec):
+    """Converts RA, Dec (degrees) to an (n, 3) array of unit vectors"""
+    ra = np.radians(np.atleast_1d(np.asarray(ra, dtype=float)))
+    dec = np.radians(np.atleast_1d(np.asarray(dec, dtype=float)))
+    cosd = np.cos(dec)
+    return np.column_stack((cosd*np.cos(ra), cosd*np.sin(ra), np.sin(dec)))
+
+def chord(radius):
+    """Converts an angular radius (arcsec) to a chord length on the unit sphere"""
+    return 2.0*math.sin(min(radius*ARCSEC, math.pi)/2.0)
+
+class SkyIndex:
+    def __init__(self, ra, dec, leafsize=16):
+        self.xyz = radec2xyz(ra, dec)
+        self.leafsize = leafsize
+        self._lo = []
+        self._hi = []
+        self._children = []
+        self._leaves = []
+        if len(self.xyz):
+            self._build(np.arange(len(self.xyz)))
+        self._lo = np.array(self._lo)
+        self._hi = np.array(self._hi)
+
+    def __len__(self):
+        return len(self.xyz)
+
+    def _build(self, idx):
+        pts = self.xyz[idx]
+        lo = pts.min(axis=0)
+        hi = pts.max(axis=0)
+        node = len(self._lo)
+        self._lo.append(lo)
+        self._hi.append(hi)
+        self._children.append(None)
+        self._leaves.append(None)
+        if len(idx) <= self.leafsize:
+            self._leaves[node] = idx
+        else:
+            axis = int(np.argmax(hi - lo))
+            order = np.argsort(pts[:, axis], kind='stable')
+            mid = len(idx)//2
+            left = self._build(idx[order[:mid]])
+            right = self._build(idx[order[mid:]])
+            self._children[node] = (left, right)
+        return node
+
+    def queryBall(self, xyz, radius):
+        """Returns (query index, point index) arrays of all pairs closer
+        than radius (arcsec); xyz is an (m, 3) array of unit vectors."""
+        xyz = np.atleast_2d(xyz)
+        r2 = chord(radius)**2
+        qout = []
+        pout = []
+        if len(self.xyz) and len(xyz):
+            stack = [(0, np.arange(len(xyz)))]
+            while stack:
+                node, qi = stack.pop()
+                q = xyz[qi]
+                d = np.clip(q, self._lo[node], self._hi[node]) - q
+                qi = qi[(d*d).sum(axis=1) <= r2]
+                if len(qi) == 0:
+                    continue
+                pi = self._leaves[node]
+                if pi is None:
+                    left, right = self._children[node]
+                    stack.append((left, qi))
+                    stack.append((right, qi))
+                    continue
+                diff = xyz[qi][:, None, :] - self.xyz[pi][None, :, :]
+                a, b = np.nonzero((diff*diff).sum(axis=2) <= r2)
+                qout.append(qi[a])
+                pout.append(pi[b])
+        if not qout:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        return np.concatenate(qout), np.concatenate(pout)
+
+    def cone(self, ra, dec, radius):
+        """Returns indices of points within radius (arcsec) of ra, dec (degrees)"""
+        q, p = self.queryBall(radec2xyz(ra, dec), radius)
+        return np.sort(p)
+
+    def box(self, ra, dec, width, height, pa=0.0):
+        """Returns indices of points inside a width x height (arcsec) box
+        centered on ra, dec (degrees) and rotated by pa (degrees E of N)"""
+        p = self.cone(ra, dec, 0.5*math.hypot(width, height))
+        if len(p) == 0:
+            return p
+        ra0 = math.radians(ra)
+        dec0 = math.radians(dec)
+        # standard coordinates about the box center
+        east = np.array([-math.sin(ra0), math.cos(ra0), 0.0])
+        north = np.array([-math.sin(dec0)*math.cos(ra0),
+                          -math.sin(dec0)*math.sin(ra0), math.cos(dec0)])
+        center = radec2xyz(ra, dec)[0]
+        pts = self.xyz[p]
+        w = pts @ center
+        xi = (pts @ east)/w/ARCSEC
+        eta = (pts @ north)/w/ARCSEC
+        t = math.radians(pa)
+        u = xi*math.cos(t) - eta*math.sin(t)
+        v = xi*math.sin(t) + eta*math.cos(t)
+        keep = (w > 0) & (np.abs(u) <= width/2.0) & (np.abs(v) <= height/2.0)
+        return p[keep]
+
+    def crossMatch(self, other, radius):
+        """Returns a list of (i, j, separation in arcsec) for every point i
+        of this index within radius (arcsec) of point j of other"""
+        j, i = self.queryBall(other.xyz, radius)
+        if len(i) == 0:
+            return []
+        d = np.sqrt(((self.xyz[i] - other.xyz[j])**2).sum(axis=1))
+        sep = 2.0*np.arcsin(np.clip(d/2.0, 0.0, 1.0))/ARCSEC
+        order = np.lexsort((j, i))
+        return [(int(i[k]), int(j[k]), float(sep[k])) for k in order]
@@ -0,0 +1,120 @@
+# Module: starlist
+# - Reads the header line of DSIMULATOR .out files (field name, center,
+#   equinox and PA) without reading the rest of the file
+# - Formats Keck starlist lines
+# - Scans lists of files and mask directories in parallel and streams
+#   the results back in input order
+# Usage:
+#       >>> import starlist
+#       >>> h = starlist.readHeader('mask1.out')
+#       >>> print(starlist.formatEntry(h), end='')
+#       mask1             10 56 59.90 -03 37 37.9 2000 rotdest=12.00 rotmode=pa
+#       >>> for path, h in starlist.scanHeaders(['masks/'], workers=8):
+#       ...     print(starlist.record(h))
+# External modules needed:
+#       None
+
+import os
+import re
+
+header_pattern = re.compile(
+    r"^(.+)\s+(\d+:\d+:\d+\.\d+)\s+(\S*\d+:\d+:\d+\.\d+)\s+(\S+)\s+PA=\s*(\S*)\s+##")
+
+class MaskHeader:
+    def __init__(self, name, ra, dec, equinox, pa, file=None):
+        self.name = name
+        self.ra = ra
+        self.dec = dec
+        self.equinox = equinox
+        self.pa = pa
+        self.file = file
+
+def parseHeader(line, file=None):
+    """Parses the second line of a DSIMULATOR file, which contains the
+    field name, field center, equinox and PA"""
+    mobj = header_pattern.match(line)
+    if not mobj:
+        raise ValueError('line 2 does not match expected format: %r' % line)
+    return MaskHeader(mobj.group(1), mobj.group(2), mobj.group(3),
+                      float(mobj.group(4)), float(mobj.group(5)), file)
+
+def readHeader(maskfile):
+    """Reads only the first two lines of maskfile and parses the header"""
+    with open(maskfile, "r") as f:
+        f.readline()
+        line = f.readline()
+    return parseHeader(line, maskfile)
+
+def signedDec(dec):
+    """Returns dec as sdd:mm:ss.s with an explicit sign.  NOTE: this is
+    necessary because simply printing the DEC in %+03i format will yield
+    "+00" for -1 < Dec < 0!"""
+    sdec = dec.split(':')
+    if sdec[0].startswith('-'):
+        sign = '-'
+    else:
+        sign = '+'
+    return '%s%02i:%s:%s' % (sign, abs(int(sdec[0])), sdec[1], sdec[2])
+
+def formatEntry(h):
+    """Returns the Keck starlist line (with newline) for a mask header;
+    h may be a MaskHeader or any object with the same attributes"""
+    # Modified by DKM 2009-03-30: Added PA info
+    sra = h.ra.split(':')
+    sdec = signedDec(h.dec).split(':')
+    spa = float(h.pa)
+    # Sky's got no love for a negative PA
+    if spa < 0:
+        spa += 360
+    seqnx = str(h.equinox).split('.')[0]
+    targname = h.name[:16]
+    sformat = '%-16s  %02i %s %s %s %s %s %s rotdest=%.2f rotmode=pa\n'
+    return sformat % (targname, int(sra[0]), sra[1], sra[2],
+                      sdec[0], sdec[1], sdec[2], seqnx, spa)
+
+def record(h):
+    """Returns the header as a dictionary, for structured output"""
+    spa = float(h.pa)
+    if spa < 0:
+        spa += 360
+    return {"file": h.file, "name": h.name.strip(), "ra": h.ra,
+            "dec": signedDec(h.dec), "equinox": h.equinox, "pa": h.pa,
+            "rotdest": spa, "starlist": formatEntry(h).rstrip('\n')}
+
+def expandPaths(paths, pattern='.out'):
+    """Yields files from paths, replacing each directory by the sorted
+    list of its files ending in pattern"""
+    for p in paths:
+        if os.path.isdir(p):
+            names = sorted(n for n in os.listdir(p) if n.endswith(pattern))
+            for n in names:
+                yield os.path.join(p, n)
+        else:
+            yield p
+
+def _read(maskfile):
+    try:
+        return readHeader(maskfile)
+    except Exception as err:
+        return err
+
+def scanHeaders(paths, workers=8):
+    """Yields (file, MaskHeader) for every mask file in paths, in input
+    order, reading the headers with a pool of workers threads.  A file
+    that cannot be read yields its exception in place of the header."""
+    files = expandPaths(paths)
+    if workers <= 1:
+        for f in files:
+            yield f, _read(f)
+        return
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        for f in files:
+            pending.append((f, pool.submit(_read, f)))
+            # keep a bounded window of reads in flight
+            if len(pending) >= 4*workers:
+                f, fut = pending.pop(0)
+                yield f, fut.result()
+        for f, fut in pending:
+            yield f, fut.result()
@@ -0,0 +1,186 @@
+"""Checks spatial.SkyIndex cone and crossMatch queries against brute force,
+the box position angle convention, and the mask queries built on them:
+Mask.guiderField against the box drawn on the guider view, and MaskSet.
+
+Usage:
+        python -m pytest test_spatial.py
+        python test_spatial.py
+"""
+
+import math
+
+import numpy as np
+
+import angles
+import spatial
+
+def separation(ra1, dec1, ra2, dec2):
+    """Angular separation (arcsec) by the haversine formula; all
+    arguments in degrees and broadcast against each other"""
+    ra1, dec1, ra2, dec2 = [np.radians(np.asarray(a, dtype=float))
+                            for a in (ra1, dec1, ra2, dec2)]
+    h = (np.sin((dec2 - dec1)/2.0)**2 +
+         np.cos(dec1)*np.cos(dec2)*np.sin((ra2 - ra1)/2.0)**2)
+    return np.degrees(2.0*np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0))))*3600.0
+
+def catalogs(seed=0):
+    """Yields (name, ra, dec, radius): a uniform field, tight clusters,
+    a field on the north pole and one across RA 0/360"""
+    rng = np.random.default_rng(seed)
+    n = 3000
+    yield ('uniform', rng.uniform(164.0, 164.5, n), rng.uniform(-3.9, -3.4, n), 30.0)
+    centers = rng.uniform(0.0, 0.2, (20, 2)) + (150.0, 2.0)
+    k = rng.integers(0, len(centers), n)
+    yield ('clustered', centers[k, 0] + rng.normal(0.0, 5e-4, n),
+           centers[k, 1] + rng.normal(0.0, 5e-4, n), 2.0)
+    yield ('pole', rng.uniform(0.0, 360.0, n), 90.0 - rng.uniform(0.0, 0.1, n), 60.0)
+    yield ('ra wrap', rng.uniform(-0.1, 0.1, n) % 360.0, rng.uniform(-0.1, 0.1, n), 20.0)
+
+def ambiguous(sep, radius):
+    # pairs this close to the radius may fall either side of it
+    return np.abs(sep - radius) < 1e-6
+
+def test_cone():
+    for name, ra, dec, radius in catalogs():
+        idx = spatial.SkyIndex(ra, dec)
+        for i in range(0, len(ra), 97):
+            sep = separation(ra[i], dec[i], ra, dec)
+            got = set(idx.cone(ra[i], dec[i], radius).tolist())
+            want = set(np.nonzero(sep <= radius)[0].tolist())
+            diff = got ^ want
+            assert not [j for j in diff if not ambiguous(sep[j], radius)], name
+
+def test_crossMatch():
+    for name, ra, dec, radius in catalogs():
+        half = len(ra)//2
+        a = spatial.SkyIndex(ra[:half], dec[:half])
+        b = spatial.SkyIndex(ra[half:], dec[half:])
+        sep = separation(ra[:half, None], dec[:half, None], ra[None, half:], dec[None, half:])
+        got = dict(((i, j), s) for i, j, s in a.crossMatch(b, radius))
+        want = set(zip(*[v.tolist() for v in np.nonzero(sep <= radius)]))
+        diff = set(got) ^ want
+        assert not [p for p in diff if not ambiguous(sep[p], radius)], name
+        for (i, j), s in got.items():
+            assert abs(s - sep[i, j]) < 1e-6, name
+
+def test_box_pa():
+    # a thin box rotated by pa (E of N) holds the points along pa
+    ra0, dec0 = 164.25, -3.6
+    r = 90.0/3600.0
+    idx = spatial.SkyIndex(
+        [ra0 + r*math.sin(math.radians(t))/math.cos(math.radians(dec0))
+         for t in (30.0, -30.0, 210.0)],
+        [dec0 + r*math.cos(math.radians(t)) for t in (30.0, -30.0, 210.0)])
+    assert idx.box(ra0, dec0, 10.0, 200.0, pa=30.0).tolist() == [0, 2]
+    assert idx.box(ra0, dec0, 10.0, 200.0, pa=-30.0).tolist() == [1]
+    assert idx.box(ra0, dec0, 200.0, 10.0, pa=-60.0).tolist() == [0, 2]
+
+def maskLines(name, pa, ra0, dec0, objects):
+    """Returns the lines of a DSIMULATOR file for a mask centered on
+    ra0, dec0 (degrees) with objects [(id, ra, dec, pcode)]"""
+    sexra = lambda ra: angles.dms2sex(angles.deg2hrs(ra))
+    lines = ['# This file was generated by DSIMULATOR\n',
+             '%-16s %s %s 2000.0 PA=%6.2f ##\n' % (name, sexra(ra0), angles.dms2sex(dec0), pa),
+             '#\n',
+             '# Guider center: %s %s\n' % (sexra(ra0), angles.dms2sex(dec0)),
+             '#\n', '# Selected Objects:\n',
+             '# OBJNAME RA DEC EQX MAG band PCODE LIST SEL PA L1 L2 LEN\n']
+    for id, ra, dec, pcode in objects:
+        lines.append('%s %s %s 2000.0 15.00 R %d 1 1 INDEF 2.0 2.0 1.0\n'
+                     % (id, sexra(ra), angles.dms2sex(dec), pcode))
+    lines += ['\n', '# Selected Guide Stars:\n', '# OBJNAME RA DEC EQX MAG X Y\n']
+    for id, ra, dec, pcode in objects:
+        if pcode == -1:
+            lines.append('# %s %s %s 2000.0 15.00 1000 1000\n' % (id, sexra(ra), angles.dms2sex(dec)))
+    lines += ['\n', '# Non-Selected Objects:\n']
+    return lines
+
+def plate(ra0, dec0, rotation=0.15):
+    """Returns a DSS with a linear plate solution (1 arcsec pixels, rotated
+    by rotation degrees) whose 900x900 frame is centered on ra0, dec0"""
+    import dss
+    d = dss.DSS()
+    s = 67.2
+    t = math.radians(rotation)
+    d.wcs = {"xpoff": 6550.0, "ypoff": 6550.0, "xpsize": 15.0, "ypsize": 15.0,
+             "ppo3": 105000.0, "ppo6": 105000.0,
+             "xcoeff": [s*math.cos(t), -s*math.sin(t)] + [0.0]*11,
+             "ycoeff": [s*math.cos(t), s*math.sin(t)] + [0.0]*11,
+             "plate_ra": math.radians(ra0), "plate_dec": math.radians(dec0),
+             "platescl": s, "naxis1": 900.0, "naxis2": 900.0}
+    return d
+
+def test_guiderField():
+    import deimos_guider_dss as guider
+    ra0, dec0 = 164.25, -3.6
+    rng = np.random.default_rng(1)
+    n = 4000
+    ra = ra0 + rng.uniform(-160.0, 160.0, n)/3600.0/math.cos(math.radians(dec0))
+    dec = dec0 + rng.uniform(-160.0, 160.0, n)/3600.0
+    objects = [('obj%d' % i, ra[i], dec[i], 100) for i in range(n)]
+    d = plate(ra0, dec0)
+    half = guider.guider_ccd[0]/2.0
+    for pa in (37.0, -120.0, 91.4):
+        m = guider.Mask()
+        m.parseLines(maskLines('field', pa, ra0, dec0, objects))
+        # the drawn box: guider_ccd pixels square in the view, which is the
+        # DSS frame rotated by guiderRotation about the guider center
+        gx, gy = d.rd2xyArray([angles.hrs2deg(angles.sex2deg(m.guider_ra))],
+                              [angles.sex2deg(m.guider_dec)])
+        x, y = d.rd2xyArray([angles.hrs2deg(angles.sex2deg(o.ra)) for o in m.objects()],
+                            [angles.sex2deg(o.dec) for o in m.objects()])
+        r = math.radians(guider.guiderRotation(m))
+        rx = (x - gx[0])*math.cos(r) - (y - gy[0])*math.sin(r)
+        ry = (x - gx[0])*math.sin(r) + (y - gy[0])*math.cos(r)
+        edge = np.maximum(np.abs(rx), np.abs(ry))
+        selected = np.zeros(len(edge), dtype=bool)
+        ids = dict((o.id, i) for i, o in enumerate(m.objects()))
+        for o in m.guiderField():
+            selected[ids[o.id]] = True
+        # everything selected is in the drawn box, and everything in the
+        # drawn box is selected, to within a pixel at the edge
+        assert (edge[selected] <= half + 1.0).all(), pa
+        assert selected[edge <= half - 1.0].all(), pa
+        assert selected.sum() > 100 and (~selected).sum() > 100
+
+def test_MaskSet():
+    import deimos_guider_dss as guider
+    ra0, dec0 = 164.25, -3.6
+    rng = np.random.default_rng(2)
+    masks = []
+    for k in range(3):
+        ra = ra0 + rng.uniform(-0.05, 0.05, 300)
+        dec = dec0 + rng.uniform(-0.05, 0.05, 300)
+        objects = [('m%do%d' % (k, i), ra[i], dec[i], 100) for i in range(300)]
+        # one guide star shared by every mask
+        objects.append(('gs%d' % k, ra0 + 0.01, dec0 + 0.01, -1))
+        m = guider.Mask()
+        m.parseLines(maskLines('mask%d' % k, 10.0*k, ra0, dec0, objects))
+        masks.append(m)
+    ms = guider.MaskSet(masks)
+    radius = 5.0
+    deg = lambda o: (angles.hrs2deg(angles.sex2deg(o.ra)), angles.sex2deg(o.dec))
+    want = set()
+    for a in range(len(masks)):
+        for b in range(a + 1, len(masks)):
+            for o in masks[a].objects():
+                for p in masks[b].objects():
+                    if separation(*(deg(o) + deg(p))) <= radius:
+                        want.add((o.id, p.id))
+    got = set((o.id, p.id) for m1, o, m2, p, sep in ms.crossMatch(radius))
+    assert got == want and want
+    shared = ms.sharedGuideStars()
+    assert sorted((o.id, p.id) for m1, o, m2, p, sep in shared) == \
+        [('gs0', 'gs1'), ('gs0', 'gs2'), ('gs1', 'gs2')]
+    got = set(o.id for m, o in ms.cone(masks[0].guider_ra, masks[0].guider_dec, 60.0))
+    want = set(o.id for m in masks for o in m.objects()
+               if separation(*(deg(o) + (ra0, dec0))) <= 60.0)
+    assert got == want
+
+if __name__ == '__main__':
+    test_cone()
+    test_crossMatch()
+    test_box_pa()
+    test_guiderField()
+    test_MaskSet()
+    print("spatial: index and mask queries agree with brute force")
@@ -0,0 +1,275 @@
+# Module: tiles
+# - Cuts the display version of a whole DSS frame into a pyramid of
+#   tile x tile JPEG tiles, halving the resolution at each level until
+#   the frame fits in one tile
+# - Builds incrementally: a manifest records the source image, so an
+#   up-to-date pyramid is skipped and an interrupted one is completed;
+#   the tiles of a level are encoded in parallel
+# - Writes a small HTML viewer that loads only the visible tiles and
+#   draws the mask overlays (guider box, guide stars, objects) on the
+#   client from the exported DSS pixel positions
+# Usage:
+#       >>> import tiles
+#       >>> info = tiles.buildPyramid('ms1054_dss.fits', 'ms1054_tiles')
+#       >>> html = tiles.viewerPage(m, dss, info, 'ms1054_tiles')
+# External modules needed:
+#       numpy, astropy, PIL
+#
+# Tiles are stored as <dir>/<level>/<column>_<row>.jpg; level 0 is the
+# coarsest.  Overlay positions are in pixels of the finest level, whose
+# rows run from north-ish at the top like the other displays.
+
+import html
+import json
+import os
+
+import numpy as np
+
+def sourceStamp(fitsfile):
+    st = os.stat(fitsfile)
+    return [st.st_size, st.st_mtime]
+
+def readFrame(fitsfile):
+    """Returns the whole image of fitsfile; the file is closed on return"""
+    import astropy.io.fits as fits
+    import dss
+    with fits.open(fitsfile) as hdulist:
+        return np.array(dss.imageHDU(hdulist).data)
+
+def levels(grey, tile=256):
+    """Returns the pyramid of grey, coarsest first: each level is the
+    2x2 mean of the next, down to the first that fits in one tile"""
+    out = [grey]
+    a = grey
+    while max(a.shape) > tile:
+        if a.shape[0] % 2 or a.shape[1] % 2:
+            a = np.pad(a, ((0, a.shape[0] % 2), (0, a.shape[1] % 2)), mode='edge')
+        f = a.astype(np.float32)
+        a = ((f[0::2, 0::2] + f[1::2, 0::2] + f[0::2, 1::2] + f[1::2, 1::2])/4.0
+             + 0.5).astype(np.uint8)
+        out.append(a)
+    out.reverse()
+    return out
+
+def tileName(outdir, level, col, row):
+    return os.path.join(outdir, str(level), '%d_%d.jpg' % (col, row))
+
+def _save(a, path, quality):
+    # write then rename, so an interrupted build leaves no partial tile
+    import PIL.Image as Image
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    Image.fromarray(a).save(tmp, format='JPEG', quality=quality)
+    os.replace(tmp, path)
+
+def _writeManifest(info, manifest):
+    tmp = '%s.%d.tmp' % (manifest, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(info, f)
+    os.replace(tmp, manifest)
+
+def readManifest(manifest):
+    """Returns the manifest of a pyramid, or None when it is missing or
+    unreadable"""
+    try:
+        with open(manifest) as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return info if isinstance(info, dict) else None
+
+def buildPyramid(fitsfile, outdir, tile=256, quality=80, workers=4):
+    """Builds the tile pyramid of fitsfile in outdir and returns its
+    manifest.  Nothing is decoded when the pyramid is up to date, and
+    only missing tiles are written when a build was interrupted."""
+    stamp = sourceStamp(fitsfile)
+    manifest = os.path.join(outdir, 'manifest.json')
+    old = readManifest(manifest)
+    if old is not None:
+        if old.get("source") == stamp and old.get("tile") == tile and old.get("complete"):
+            return old
+        if old.get("source") != stamp or old.get("tile") != tile:
+            old = None
+    import fits2pil
+    pyramid = levels(fits2pil.arrayToGreyArray(readFrame(fitsfile)), tile)
+    info = {"source": stamp, "tile": tile, "format": "jpg",
+            "levels": [[a.shape[1], a.shape[0]] for a in pyramid],
+            "complete": False}
+    for z in range(len(pyramid)):
+        d = os.path.join(outdir, str(z))
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    _writeManifest(info, manifest)
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        jobs = []
+        for z, a in enumerate(pyramid):
+            for row in range(0, -(-a.shape[0]//tile)):
+                for col in range(0, -(-a.shape[1]//tile)):
+                    path = tileName(outdir, z, col, row)
+                    if old is not None and os.path.exists(path):
+                        continue
+                    t = a[row*tile:(row+1)*tile, col*tile:(col+1)*tile]
+                    jobs.append(pool.submit(_save, t, path, quality))
+        for j in jobs:
+            j.result()
+
+    info["complete"] = True
+    _writeManifest(info, manifest)
+    return info
+
+def overlay(m, dss, naxis2):
+    """Returns the overlay of mask m for the viewer: guider box corners,
+    guide stars and objects in finest-level pixel coordinates"""
+    import export
+    import guidersim
+    cols = export.maskColumns(m, dss)
+
+    def xy(x, y):
+        # 1-based DSS pixels to display pixels (rows flipped)
+        return [[round(float(a) - 0.5, 2), round(naxis2 - float(b) + 0.5, 2)]
+                for a, b in zip(x, y)]
+
+    geom = guidersim.tvGeometry(m, dss)
+    ny, nx = geom.shape
+    bx, by = geom.toDSS([0.5, nx + 0.5, nx + 0.5, 0.5], [0.5, 0.5, ny + 0.5, ny + 0.5])
+    o = cols["objects"]
+    g = cols["guidestars"]
+    return {"name": m.name.strip(), "pa": m.pa,
+            "box": xy(bx, by),
+            "guidestars": [{"id": i, "xy": p, "xTV": tx, "yTV": ty}
+                           for i, p, tx, ty in zip(g["id"], xy(g["dss_x"], g["dss_y"]),
+                                                   g["xTV"], g["yTV"])],
+            "objects": [{"id": i, "kind": k, "xy": p}
+                        for i, k, p in zip(o["id"], o["kind"], xy(o["dss_x"], o["dss_y"]))
+                        if k != 'guide']}
+
+viewer_template = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>%(title)s</title>
+<style>
+body { margin: 0; font: 13px sans-serif; }
+#bar { padding: 4px 8px; background: #B0C4DE; }
+#view { position: relative; overflow: hidden; height: calc(100vh - 30px);
+        background: #fff; cursor: grab; touch-action: none; }
+#view img { position: absolute; user-select: none; -webkit-user-drag: none; }
+#view svg { position: absolute; left: 0; top: 0; width: 100%%; height: 100%%;
+            pointer-events: none; }
+</style>
+</head>
+<body>
+<div id="bar"><b>%(title)s</b>
+<button id="zin">+</button> <button id="zout">&minus;</button>
+<button id="fit">fit</button>
+<label><input type="checkbox" id="labels" checked> labels</label>
+<span id="status"></span></div>
+<div id="view"><svg id="ovl"></svg></div>
+<script>
+(function () {
+var pyramid = %(pyramid)s;
+var overlay = %(overlay)s;
+var tiles = %(tiles)s;
+var view = document.getElementById('view'), svg = document.getElementById('ovl');
+var zmax = pyramid.levels.length - 1, T = pyramid.tile;
+var W = pyramid.levels[zmax][0], H = pyramid.levels[zmax][1];
+var s = 1, tx = 0, ty = 0, shown = {};
+var colors = {target: '#00ff00', alignment: '#ff00ff', guide: '#ff0000'};
+function fit() {
+  s = Math.min(view.clientWidth / W, view.clientHeight / H);
+  tx = (view.clientWidth - W * s) / 2; ty = (view.clientHeight - H * s) / 2;
+  draw();
+}
+function draw() {
+  // the coarsest level with at least one tile pixel per screen pixel
+  var z = Math.max(0, Math.min(zmax, zmax + Math.ceil(Math.log2(s) - 1e-9)));
+  var f = Math.pow(2, zmax - z), lw = pyramid.levels[z][0], lh = pyramid.levels[z][1];
+  var c0 = Math.max(0, Math.floor(-tx / (s * f * T))), r0 = Math.max(0, Math.floor(-ty / (s * f * T)));
+  var c1 = Math.min(Math.ceil(lw / T) - 1, Math.floor((view.clientWidth - tx) / (s * f * T)));
+  var r1 = Math.min(Math.ceil(lh / T) - 1, Math.floor((view.clientHeight - ty) / (s * f * T)));
+  var want = {};
+  for (var r = r0; r <= r1; r++) for (var c = c0; c <= c1; c++) {
+    var key = z + '/' + c + '_' + r, img = shown[key];
+    want[key] = true;
+    if (!img) {
+      img = shown[key] = document.createElement('img');
+      img.src = tiles + '/' + key + '.' + pyramid.format;
+      img.draggable = false;
+      view.insertBefore(img, svg);
+    }
+    var w = Math.min(T, lw - c * T), h = Math.min(T, lh - r * T);
+    img.style.left = (tx + c * T * f * s) + 'px'; img.style.top = (ty + r * T * f * s) + 'px';
+    img.style.width = (w * f * s) + 'px'; img.style.height = (h * f * s) + 'px';
+  }
+  for (var k in shown) if (!want[k]) { view.removeChild(shown[k]); delete shown[k]; }
+  drawOverlay();
+  document.getElementById('status').textContent =
+    'level ' + z + ', ' + Object.keys(shown).length + ' tiles, ' + (s * 100).toFixed(0) + '%%';
+}
+function P(p) { return [tx + p[0] * s, ty + p[1] * s]; }
+function node(name, attrs, text) {
+  var e = document.createElementNS('http://www.w3.org/2000/svg', name);
+  for (var a in attrs) e.setAttribute(a, attrs[a]);
+  if (text !== undefined) e.textContent = text;
+  svg.appendChild(e);
+}
+function drawOverlay() {
+  var labels = document.getElementById('labels').checked;
+  while (svg.firstChild) svg.removeChild(svg.firstChild);
+  node('polygon', {points: overlay.box.map(function (p) { return P(p).join(','); }).join(' '),
+                   fill: 'none', stroke: '#ffff00'});
+  overlay.objects.forEach(function (o) {
+    var q = P(o.xy);
+    node('rect', {x: q[0] - 4, y: q[1] - 4, width: 8, height: 8, fill: 'none', stroke: colors[o.kind]});
+    if (labels && s >= 2) node('text', {x: q[0] + 6, y: q[1] - 6, fill: colors[o.kind]}, o.id);
+  });
+  overlay.guidestars.forEach(function (g) {
+    var q = P(g.xy);
+    node('circle', {cx: q[0], cy: q[1], r: 10, fill: 'none', stroke: '#ff0000'});
+    if (labels) node('text', {x: q[0] + 12, y: q[1] - 12, fill: '#ff0000'}, g.id.toUpperCase());
+  });
+}
+function zoom(k, cx, cy) {
+  tx = cx - (cx - tx) * k; ty = cy - (cy - ty) * k; s *= k; draw();
+}
+view.addEventListener('wheel', function (e) {
+  e.preventDefault();
+  var r = view.getBoundingClientRect();
+  zoom(e.deltaY < 0 ? 1.25 : 0.8, e.clientX - r.left, e.clientY - r.top);
+}, {passive: false});
+var drag = null;
+view.addEventListener('pointerdown', function (e) {
+  drag = [e.clientX - tx, e.clientY - ty]; view.setPointerCapture(e.pointerId);
+});
+view.addEventListener('pointermove', function (e) {
+  if (drag) { tx = e.clientX - drag[0]; ty = e.clientY - drag[1]; draw(); }
+});
+view.addEventListener('pointerup', function () { drag = null; });
+document.getElementById('zin').onclick = function () { zoom(2, view.clientWidth / 2, view.clientHeight / 2); };
+document.getElementById('zout').onclick = function () { zoom(0.5, view.clientWidth / 2, view.clientHeight / 2); };
+document.getElementById('fit').onclick = fit;
+document.getElementById('labels').onchange = drawOverlay;
+window.addEventListener('resize', draw);
+fit();
+})();
+</script>
+</body>
+</html>
+'''
+
+def _script(value):
+    """Returns value as JSON that is safe inside a <script> element"""
+    return json.dumps(value).replace('</', '<\\/')
+
+def viewerPage(m, dss, info, tiledir):
+    """Returns the zoomable viewer page of mask m over the pyramid
+    described by info (from buildPyramid) in directory tiledir, given
+    relative to the page"""
+    pyramid = {"tile": info["tile"], "format": info["format"], "levels": info["levels"]}
+    naxis2 = info["levels"][-1][1]
+    return viewer_template % {
+        "title": html.escape(m.name.strip()),
+        "pyramid": _script(pyramid),
+        "overlay": _script(overlay(m, dss, naxis2)),
+        "tiles": _script(tiledir.replace(os.sep, '/'))}